@@ -0,0 +1,180 @@
+"""
+Measures decode_sam.py throughput and memory on synthetic databases from
+make_synthetic_db.py, across database sizes, off-target loads and decode
+configurations. Every configuration's output is checked against the
+serial baseline, so regressions in speed and in correctness both show up.
+"""
+
+import argparse
+import csv
+import hashlib
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+CONFIGS = {
+    'serial': ['--workers', '1', '--cache-size', '0'],
+    'cached': ['--workers', '1'],
+    'parallel': ['--workers', '{workers}'],
+}
+
+FIELDS = ['records', 'mean_offtargets', 'mode', 'config', 'wall_time_s',
+          'offtargets', 'offtargets_per_s', 'peak_rss_mb', 'peak_rss_children_mb',
+          'speedup', 'identical']
+
+def run_script(script, *args):
+    cmd = [sys.executable, os.path.join(SCRIPT_DIR, script), *map(str, args)]
+    return subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout
+
+def make_database(tmp_dir, records, mean_offtargets, args):
+    prefix = os.path.join(tmp_dir, f'synthetic_{records}_{mean_offtargets}')
+    run_script('make_synthetic_db.py', prefix, '--records', records,
+               '--mean-offtargets', mean_offtargets, '--genome-size', args.genome_size,
+               '--contigs', args.contigs, '--distribution', args.distribution,
+               '--duplicate-fraction', args.duplicate_fraction, '--seed', args.seed)
+    # packs the genome, so that no run is charged for it
+    run_script('pack_genome.py', prefix + '.fa')
+    return prefix + '.bam', prefix + '.fa.packed'
+
+def benchmark(database, genome, mode, config, args):
+    """
+    Best of args.repeats runs of one configuration; returns its profile
+    and the digest of its output.
+    """
+    best = None
+    options = [option.format(workers=args.workers) for option in CONFIGS[config]]
+    with tempfile.NamedTemporaryFile(suffix='.json') as profile:
+        for _ in range(args.repeats):
+            output = run_script('decode_sam.py', database, genome, '--mode', mode,
+                                '--profile', profile.name, *options)
+            with open(profile.name) as f:
+                report = json.load(f)
+            if best is None or report['wall_time_s'] < best['wall_time_s']:
+                best = report
+    return best, hashlib.sha1(output).hexdigest()
+
+def parse_args():
+    p = argparse.ArgumentParser(
+        description="Benchmarks decode_sam.py on synthetic gRNA databases, writing one CSV row per run."
+    )
+
+    p.add_argument(
+        "--records",
+        help="Database sizes to benchmark.",
+        type=int,
+        nargs='+',
+        default=[1000, 10000]
+    )
+
+    p.add_argument(
+        "--mean-offtargets",
+        help="Mean off-target counts per guide to benchmark.",
+        type=float,
+        nargs='+',
+        default=[10, 100]
+    )
+
+    p.add_argument(
+        "--modes",
+        nargs='+',
+        choices=['succinct', 'complete'],
+        default=['succinct', 'complete']
+    )
+
+    p.add_argument(
+        "--configs",
+        help="Decode configurations; serial disables the off-target cache.",
+        nargs='+',
+        choices=list(CONFIGS),
+        default=list(CONFIGS)
+    )
+
+    p.add_argument(
+        "--workers",
+        help="Worker processes for the parallel configuration.",
+        type=int,
+        default=os.cpu_count()
+    )
+
+    p.add_argument(
+        "--genome-size",
+        type=int,
+        default=10_000_000
+    )
+
+    p.add_argument(
+        "--contigs",
+        type=int,
+        default=24
+    )
+
+    p.add_argument(
+        "--distribution",
+        choices=['fixed', 'poisson', 'geometric', 'pareto'],
+        default='geometric'
+    )
+
+    p.add_argument(
+        "--duplicate-fraction",
+        type=float,
+        default=0.2
+    )
+
+    p.add_argument(
+        "--repeats",
+        help="Runs per configuration; the fastest is reported.",
+        type=int,
+        default=3
+    )
+
+    p.add_argument(
+        "--seed",
+        type=int,
+        default=0
+    )
+
+    p.add_argument(
+        "-o", "--output",
+        help="Output CSV (default: stdout)."
+    )
+
+    return p.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    out = open(args.output, 'w', newline='') if args.output else sys.stdout
+    writer = csv.DictWriter(out, fieldnames=FIELDS)
+    writer.writeheader()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for records, mean_offtargets in itertools.product(args.records, args.mean_offtargets):
+            database, genome = make_database(tmp_dir, records, mean_offtargets, args)
+            for mode in args.modes:
+                baseline_time, baseline_digest = None, None
+                for config in args.configs:
+                    report, digest = benchmark(database, genome, mode, config, args)
+                    if baseline_digest is None:
+                        baseline_time, baseline_digest = report['wall_time_s'], digest
+                    writer.writerow({
+                        'records': records,
+                        'mean_offtargets': mean_offtargets,
+                        'mode': mode,
+                        'config': config,
+                        'wall_time_s': f"{report['wall_time_s']:.3f}",
+                        'offtargets': report['offtargets'],
+                        'offtargets_per_s': f"{report['offtargets_per_s']:.0f}",
+                        'peak_rss_mb': f"{report['peak_rss_mb']:.1f}",
+                        'peak_rss_children_mb': f"{report['peak_rss_children_mb']:.1f}",
+                        'speedup': f"{baseline_time / report['wall_time_s']:.2f}",
+                        'identical': digest == baseline_digest,
+                    })
+                    out.flush()
+
+    if args.output:
+        out.close()
@@ -1,18 +1,41 @@
 import pickle
 import os
-import numpy as np
 import argparse
-import pysam
+import importlib.util
 import sys
 import binascii
+import hashlib
+import heapq
+import json
+import multiprocessing
+import queue
+import resource
+import tempfile
+import threading
+import time
 
-from Bio import SeqIO
+from collections import OrderedDict, defaultdict, deque
+from functools import lru_cache, reduce
 
-from functools import reduce
+def lazy_import(name):
+    """
+    Returns module name, deferring its import until an attribute is first
+    accessed, so --help and small jobs skip imports they never use.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
 
-def repeat(item):
-    while True:
-        yield item
+np = lazy_import('numpy')
+pysam = lazy_import('pysam')
+pack_genome = lazy_import('pack_genome')
+query_offtargets = lazy_import('query_offtargets')
 
 def get_length(genome):
     return sum(p['LN'] for p in genome)
@@ -24,63 +47,165 @@ def ilen(iterable):
     return reduce(lambda sum, _: sum + 1, iterable, 0)
 
 def hex_to_array(hexstr):
-    return np.frombuffer(binascii.unhexlify(hexstr), dtype=int)
+    return np.frombuffer(binascii.unhexlify(hexstr), dtype='<i8')
 
-def hex_to_offtargetinfo(hexstr, delim):
+def hex_to_offtarget_arrays(hexstr, delim):
+    """
+    Decodes a hex off-target payload, a sequence of groups [pos, ..., pos,
+    distance, delim]; returns parallel int64 arrays of the distances and
+    positions of every off-target, in payload order.
+    """
     mainarr = hex_to_array(hexstr)
-    index = np.where(mainarr == delim)[0]
-    slices = list(zip(np.insert(index, 0, -1), index))
-    out = []
-    for start, end in slices:
-        out += zip(repeat(mainarr[end - 1]), mainarr[start + 1:end - 1])
-    return out
-
-def map_int_to_coord(x, genome, onebased=False):
-    strand = '+' if x > 0 else '-'
-    x = abs(x)
-    i = 0
-    while genome[i]['LN'] <= x:
-        x -= genome[i]['LN']
-        i += 1
-    chrom = genome[i]['SN']
-    coord = x
+    is_delim = mainarr == delim
+    ends = np.flatnonzero(is_delim)
+    if len(ends) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    is_pos = ~is_delim
+    is_pos[ends[ends > 0] - 1] = False
+    is_pos[ends[-1] + 1:] = False
+
+    group = np.cumsum(is_delim) - is_delim
+    distances = mainarr[ends - 1][group[is_pos]]
+    return distances, mainarr[is_pos]
+
+def build_offset_index(genome):
+    """
+    Builds the cumulative-length offset index of the @SQ header list used
+    by map_ints_to_coords: (chromosome names, start offsets, end offsets).
+    """
+    lengths = np.array([sq['LN'] for sq in genome], dtype=np.int64)
+    ends = np.cumsum(lengths)
+    return [sq['SN'] for sq in genome], ends - lengths, ends
+
+def map_ints_to_coords(xs, offset_index, onebased=False):
+    """
+    Maps encoded off-target positions, signed by strand, to parallel arrays
+    of chromosome ids (indices into the @SQ list), coordinates and strands.
+    """
+    _, starts, ends = offset_index
+    xs = np.asarray(xs, dtype=np.int64)
+    strands = np.where(xs > 0, '+', '-')
+    xs = np.abs(xs)
+    chrom_ids = np.searchsorted(ends, xs, side='right')
+    if len(chrom_ids) and chrom_ids.max() >= len(ends):
+        raise IndexError("Encoded off-target position lies beyond the end of the genome")
+    coords = xs - starts[chrom_ids]
     if onebased:
-        coord += 1
-    t = (chrom, coord, strand)
-    return t
-
-def map_coord_to_sequence(fasta_record_dict, sgrna, chr, pos, strand):
-    if strand == '+':
-        pos_start = pos + 1 - len(sgrna)
-        pos_end = pos + 1
-    else:
-        pos_start = pos
-        pos_end = pos + len(sgrna)
-    return fasta_record_dict[chr].seq[pos_start:pos_end].upper()
+        coords += 1
+    return chrom_ids, coords, strands
 
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 
 ###############
-## CFD Score ##
+## Profiling ##
 ###############
 
-def calc_cfd_e(sg,wt,pam,mm_scores,pam_scores):
-    score = 1
-    wt = wt.replace('T','U')
-    sg = sg.replace('T','U')
-    wt_list = list(wt)
-    sg_list = list(sg)
-    for i,wl in enumerate(wt_list):
-        if sg_list[i] == wl:
-            score*=1
-        else:
-            try:
-                key = 'r'+sg_list[i]+':d'+revcom(wl)+','+str(i+1)
-                score*= mm_scores[key]
-            except KeyError:
-                continue
-    score*=pam_scores[pam]
-    return (score)
+STAGES = ['bam_iteration', 'hex_decoding', 'map_int_to_coord',
+          'map_coord_to_sequence', 'calc_cfd', 'output', 'write']
+
+class Stage:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.profiler.times[self.name] += time.perf_counter() - self.start
+        self.profiler.calls[self.name] += 1
+
+class NullStage:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+class Profiler:
+    """
+    Cumulative wall time and call counts per decoding stage, plus record
+    and off-target counters. Disabled profilers cost one attribute check
+    per stage.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.null_stage = NullStage()
+        self.reset()
+
+    def reset(self):
+        self.times = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counts = defaultdict(int)
+
+    def stage(self, name):
+        return Stage(self, name) if self.enabled else self.null_stage
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counts[name] += n
+
+    def iterate(self, name, iterable):
+        """
+        Yields from iterable, timing every step as stage name.
+        """
+        if not self.enabled:
+            yield from iterable
+            return
+
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def snapshot(self):
+        return dict(self.times), dict(self.calls), dict(self.counts)
+
+    def merge(self, snapshot):
+        times, calls, counts = snapshot
+        for name, t in times.items():
+            self.times[name] += t
+        for name, n in calls.items():
+            self.calls[name] += n
+        for name, n in counts.items():
+            self.counts[name] += n
+
+    def report(self, wall_time):
+        """
+        Report as a JSON-serializable dict. In multi-process runs stage
+        times are summed over the workers.
+        """
+        to_mb = 1 / 1024 if sys.platform != 'darwin' else 1 / 1024 ** 2
+        offtargets = self.counts['offtargets']
+        return {
+            'wall_time_s': wall_time,
+            'records': self.counts['records'],
+            'offtargets': offtargets,
+            'offtargets_per_s': offtargets / wall_time if wall_time > 0 else 0,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * to_mb,
+            'peak_rss_children_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * to_mb,
+            'stages': {
+                name: {'time_s': self.times.get(name, 0.0), 'calls': self.calls.get(name, 0)}
+                for name in STAGES
+            }
+        }
+
+    def progress(self, wall_time):
+        records, offtargets = self.counts['records'], self.counts['offtargets']
+        rate = offtargets / wall_time if wall_time > 0 else 0
+        return (f"[decode_sam] {wall_time:.1f}s: {records} records, "
+                f"{offtargets} off-targets ({rate:.0f} off-targets/s)")
+
+PROFILER = Profiler()
+
+###############
+## CFD Score ##
+###############
 
 def get_mm_pam_scores(mms,pams):
     try:
@@ -96,62 +221,392 @@ def revcom(s):
     letters = [(basecomp[base] if base in basecomp else base) for base in letters]
     return ''.join(letters)
 
+#####################
+## Batch CFD Score ##
+#####################
+
+@lru_cache(maxsize=None)
+def nuc_codes():
+    """
+    Lookup table mapping A, C, G, T/U to 0-3; every other character (N,
+    IUPAC codes, lowercase) maps to 4, which never has a mismatch or PAM
+    score.
+    """
+    codes = np.full(256, 4, dtype=np.uint8)
+    for code, nucs in enumerate(['A', 'C', 'G', 'TU']):
+        for nuc in nucs:
+            codes[ord(nuc)] = code
+    return codes
+
+CODE_TO_RNA = 'ACGU'
+CODE_TO_DNA = 'ACGT'
+
+def encode_sequences(seqs, length):
+    """
+    Encodes a list of equal length sequences as an (n, length) array of
+    nucleotide codes.
+    """
+    buf = np.frombuffer(''.join(seqs).encode('ascii'), dtype=np.uint8)
+    return nuc_codes()[buf].reshape(len(seqs), length)
+
+def compile_cfd_tables(mm_scores, pam_scores, length=20):
+    """
+    Compiles the CFD dictionaries into dense lookup arrays:
+
+        mm_table[i, sg, wt]  -- mismatch score at position i (0-based) for
+                                guide base sg against target base wt,
+                                1 for matches and unscored pairs.
+        pam_table[x, y]      -- PAM score of dinucleotide xy, NaN when
+                                the PAM has no score.
+    """
+    mm_table = np.ones((length, 5, 5), dtype=np.float64)
+    for i in range(length):
+        for sg in range(4):
+            for wt in range(4):
+                if sg == wt:
+                    continue
+                key = 'r' + CODE_TO_RNA[sg] + ':d' + revcom(CODE_TO_DNA[wt]) + ',' + str(i + 1)
+                if key in mm_scores:
+                    mm_table[i, sg, wt] = mm_scores[key]
+
+    pam_table = np.full((5, 5), np.nan, dtype=np.float64)
+    for x in range(4):
+        for y in range(4):
+            pam = CODE_TO_DNA[x] + CODE_TO_DNA[y]
+            if pam in pam_scores:
+                pam_table[x, y] = pam_scores[pam]
+
+    return mm_table, pam_table
+
+def calc_cfd_batch(sg_codes, wt_codes, pam_codes, mm_table, pam_table):
+    """
+    Scores every row of wt_codes (n, 20) and pam_codes (n, 2) against
+    sg_codes, which is either one guide (20,) or one guide per row (n, 20).
+
+    The score is the product of the mismatch scores, taken in position
+    order, times the PAM score; a PAM without a score raises KeyError.
+    """
+    wt_codes = np.asarray(wt_codes)
+    sg_codes = np.broadcast_to(sg_codes, wt_codes.shape)
+
+    score = np.ones(wt_codes.shape[0], dtype=np.float64)
+    for i in range(wt_codes.shape[1]):
+        score *= mm_table[i, sg_codes[:, i], wt_codes[:, i]]
+
+    pam_score = pam_table[pam_codes[:, 0], pam_codes[:, 1]]
+    if np.isnan(pam_score).any():
+        bad = pam_codes[np.isnan(pam_score)][0]
+        raise KeyError(''.join('ACGTN'[c] for c in bad))
+
+    score *= pam_score
+    return score
+
 PAM_PKL = SCRIPT_DIR + "/cfd/pam_scores.pkl"
 MM_PKL = SCRIPT_DIR + "/cfd/mismatch_score.pkl"
-mm_scores, pam_scores = get_mm_pam_scores(MM_PKL, PAM_PKL)
+CFD_TABLES = SCRIPT_DIR + "/cfd/cfd_tables.npz"
+
+@lru_cache(maxsize=None)
+def cfd_tables():
+    """
+    The compiled (mm_table, pam_table), loaded on first use from
+    CFD_TABLES. The tables are compiled from the pickled scores and saved
+    there whenever the pickles are newer; a read-only checkout compiles
+    them in memory instead.
+    """
+    if (os.path.exists(CFD_TABLES) and
+        all(os.path.getmtime(CFD_TABLES) >= os.path.getmtime(pkl) for pkl in [MM_PKL, PAM_PKL])):
+        with np.load(CFD_TABLES) as tables:
+            return tables['mm_table'], tables['pam_table']
+
+    mm_table, pam_table = compile_cfd_tables(*get_mm_pam_scores(MM_PKL, PAM_PKL))
+    try:
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(CFD_TABLES), suffix='.npz',
+                                         delete=False) as f:
+            np.savez(f, mm_table=mm_table, pam_table=pam_table)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(f.name, 0o666 & ~umask)
+        os.replace(f.name, CFD_TABLES)
+    except OSError:
+        pass
+    return mm_table, pam_table
+
+def map_chroms_to_genome(chrom_names, packed_genome):
+    """
+    Maps @SQ chromosome ids to packed genome contig ids, -1 where the
+    contig is missing from the genome.
+    """
+    return np.array([packed_genome.ids.get(name, -1) for name in chrom_names], dtype=np.int64)
+
+def off_target_windows(packed_genome, genome_ids, coords, strands, length):
+    """
+    Start coordinates of the off-target windows of length bases ending (+)
+    or starting (-) at coords, and a mask of the windows lying entirely
+    inside their contig.
+    """
+    starts = np.where(strands == '+', coords + 1 - length, coords)
+    inside = (starts >= 0) & (starts + length <= packed_genome.lengths[genome_ids])
+    return starts, inside
+
+def fetch_oriented_codes(packed_genome, genome_ids, starts, strands, length):
+    """
+    Code matrix of whole windows, reverse complemented on the - strand.
+    """
+    codes = packed_genome.fetch_windows(genome_ids, starts, length)
+    minus = strands == '-'
+    codes[minus] = pack_genome.COMPLEMENT_CODES[codes[minus, ::-1]]
+    return codes
+
+def resolve_off_targets(packed_genome, genome_ids, coords, strands, length):
+    """
+    Resolves the sense-oriented off-target sequences of length bases ending
+    (+) or starting (-) at coords. Returns the sequences, their code matrix
+    and a mask of the off-targets whose window lies inside the contig; the
+    others are truncated exactly as slicing the contig string would.
+    """
+    starts, inside = off_target_windows(packed_genome, genome_ids, coords, strands, length)
+
+    codes = np.full((len(starts), length), 4, dtype=np.uint8)
+    codes[inside] = fetch_oriented_codes(packed_genome, genome_ids[inside], starts[inside],
+                                         strands[inside], length)
+
+    seqs = pack_genome.decode_codes(codes)
+    for i in np.flatnonzero(~inside):
+        truncated = packed_genome.fetch(genome_ids[i], starts[i], starts[i] + length)
+        if strands[i] == '-':
+            truncated = pack_genome.COMPLEMENT_CODES[truncated[::-1]]
+        seqs[i] = pack_genome.decode_codes(truncated[None, :])[0]
+
+    return seqs, codes, inside
+
+def locate_off_targets(sam_record, offset_index, delim, genome_map):
+    """
+    Decodes the 'of' payload of sam_record, returning the oriented guide,
+    the off-target distances and their (chrom id, coordinate, strand,
+    packed genome id) arrays.
+    """
+    with PROFILER.stage('hex_decoding'):
+        distances, positions = hex_to_offtarget_arrays(sam_record.get_tag('of'), delim)
+
+    sgrna = sam_record.query_sequence
+    if sam_record.is_reverse:
+        sgrna = revcom(sgrna)
+
+    with PROFILER.stage('map_int_to_coord'):
+        chrom_ids, coords, strands = map_ints_to_coords(positions, offset_index)
+
+    genome_ids = genome_map[chrom_ids]
+    if (genome_ids < 0).any():
+        raise KeyError(offset_index[0][chrom_ids[genome_ids < 0][0]])
+
+    return sgrna, distances, chrom_ids, coords, strands, genome_ids
+
+def decode_off_targets(sam_record, offset_index, delim, packed_genome, genome_map):
+    """
+    Decodes the off-targets of sam_record into a dict of parallel columns
+    (None if the record has no off-target tag). Unscored off-targets have
+    a NaN CFD.
+    """
+    if not sam_record.has_tag('of'):
+        return None
+
+    sgrna, distances, chrom_ids, coords, strands, genome_ids = locate_off_targets(
+        sam_record, offset_index, delim, genome_map)
+
+    with PROFILER.stage('map_coord_to_sequence'):
+        seqs, codes, inside = resolve_off_targets(packed_genome, genome_ids, coords, strands, len(sgrna))
+
+    cfds = np.full(len(seqs), np.nan, dtype=np.float64)
+    if len(sgrna) == 23 and inside.any():
+        sg_codes = encode_sequences([sgrna[:20]], 20)[0]
+        mm_table, pam_table = cfd_tables()
+        scored = codes[inside]
+        with PROFILER.stage('calc_cfd'):
+            cfds[inside] = calc_cfd_batch(sg_codes, scored[:, :20], scored[:, 21:23], mm_table, pam_table)
 
-# Curry last two arguments for ease of use
-calc_cfd = lambda sg, wt, pam: calc_cfd_e(sg, wt, pam, mm_scores, pam_scores)
+    match_counts, specificity = summarize_off_targets(distances, cfds)
 
-def decode_off_targets(sam_record, genome, delim, fasta_record_dict):
+    return {
+        "identifier": sam_record.query_name,
+        "distance": distances,
+        "chrom_id": chrom_ids,
+        "chrom_names": offset_index[0],
+        "pos": coords,
+        "sense": strands,
+        "offtarget": seqs,
+        "cfd": cfds,
+        "match_counts": match_counts,
+        "specificity": specificity
+    }
+
+SPECIFICITY_CHUNK = 1024
+
+def screen_specificity(sam_record, offset_index, delim, packed_genome, genome_map, min_specificity):
+    """
+    Succinct-mode decode that only establishes whether a guide reaches
+    min_specificity. Off-targets are scored in chunks, lowest distance
+    first, and scoring stops as soon as the CFD sum accumulated so far
+    (less the guide's own site) pushes the specificity below the cutoff.
+
+    Match counts come straight from the payload. Guides that are scored to
+    the end get exactly the specificity of decode_off_targets; guides that
+    stop early are reported as failed with no specificity.
+    """
     if not sam_record.has_tag('of'):
-        return
+        return {"match_counts": [0, 0, 0, 0], "specificity": '', "passed": ''}
+
+    sgrna, distances, chrom_ids, coords, strands, genome_ids = locate_off_targets(
+        sam_record, offset_index, delim, genome_map)
+    match_counts = np.bincount(distances, minlength=4).tolist() if len(distances) else [0, 0, 0, 0]
+
+    # truncated windows and non 20-mer guides cannot be scored, which leaves
+    # the specificity undefined however the other off-targets score
+    starts, inside = off_target_windows(packed_genome, genome_ids, coords, strands, len(sgrna))
+    if len(distances) and (len(sgrna) != 23 or not inside.all()):
+        return {"match_counts": match_counts, "specificity": '', "passed": ''}
+
+    max_cfd_sum = 1 / min_specificity - 1
+    sg_codes = encode_sequences([sgrna[:20]], 20)[0]
+    mm_table, pam_table = cfd_tables()
+    on_target = np.flatnonzero(distances == 0)[:1]
+
+    cfds = np.empty(len(distances), dtype=np.float64)
+    order = np.argsort(distances, kind='stable')
+    cfd_sum = 0.0
+    for i in range(0, len(order), SPECIFICITY_CHUNK):
+        chunk = order[i:i + SPECIFICITY_CHUNK]
+        with PROFILER.stage('map_coord_to_sequence'):
+            codes = fetch_oriented_codes(packed_genome, genome_ids[chunk], starts[chunk], strands[chunk], 23)
+        with PROFILER.stage('calc_cfd'):
+            cfds[chunk] = calc_cfd_batch(sg_codes, codes[:, :20], codes[:, 21:23], mm_table, pam_table)
+
+        cfd_sum += cfds[chunk].sum()
+        if len(on_target) and on_target[0] in chunk:
+            cfd_sum -= cfds[on_target[0]]
+        if cfd_sum > max_cfd_sum:
+            return {"match_counts": match_counts, "specificity": '', "passed": False}
+
+    match_counts, specificity = summarize_off_targets(distances, cfds)
+    passed = specificity == '' or specificity >= min_specificity
+    return {"match_counts": match_counts, "specificity": specificity, "passed": passed}
+
+def summarize_off_targets(distances, cfds):
+    """
+    Returns the per-distance match counts and the specificity of a guide
+    ('' when some off-target could not be scored).
+    """
+    match_counts = [0, 0, 0, 0]
+    cfd_sum = None
+    if len(distances):
+        match_counts = np.bincount(distances, minlength=4).tolist()
 
-    ots = sam_record.get_tag('of')
-    ots = hex_to_offtargetinfo(ots, delim)
+        if not np.isnan(cfds).any():
+            cfd_sum = sum(cfds.tolist())
 
-    count = 0
-    for distance, pos in ots:
-        chrm, pos, strand = map_int_to_coord(pos, genome)
+            # the first exact match is the guide's own target site
+            on_target = np.flatnonzero(distances == 0)
+            if len(on_target):
+                cfd_sum -= cfds[on_target[0]].item()
+
+    if cfd_sum:
+        specificity = 1 / (1 + cfd_sum)
+        if cfd_sum == 0:
+            specificity = 1
+    else:
+        specificity = ''
+
+    return match_counts, specificity
+
+class OffTargetCache:
+    """
+    LRU cache of decoded off-targets keyed by guide sequence and a digest of
+    the raw 'of' payload, so duplicate guides across a library are decoded
+    once. Holds at most capacity off-targets in total.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+
+    def decode(self, sam_record, decode_ot):
+        if self.capacity <= 0 or not sam_record.has_tag('of'):
+            return decode_ot(sam_record)
 
         sgrna = sam_record.query_sequence
         if sam_record.is_reverse:
             sgrna = revcom(sgrna)
+        payload = sam_record.get_tag('of')
+        key = (sgrna, hashlib.blake2b(payload.encode(), digest_size=16).digest())
 
-        offtarget = str(map_coord_to_sequence(fasta_record_dict, sgrna, chrm, pos, strand))
+        offtargets = self.entries.get(key)
+        if offtargets is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return dict(offtargets, identifier=sam_record.query_name)
 
-        if len(offtarget) == 23:
-            seq = revcom(offtarget) if strand == '-' else offtarget
-            cfd = calc_cfd(sgrna, seq[:20], seq[21:23])
-        else:
-            cfd = None
-
-        offtarget_map = {
-            "identifier": sam_record.query_name,
-            "distance": distance,
-            "chr": chrm,
-            "pos": pos,
-            "sense": strand,
-            "offtarget": revcom(offtarget) if strand == '-' else offtarget,
-            "cfd": cfd
-        }
+        self.misses += 1
+        offtargets = decode_ot(sam_record)
+        weight = len(offtargets.get('distance', ())) + 1
+        if weight <= self.capacity:
+            self.entries[key] = offtargets
+            self.size += weight
+            while self.size > self.capacity:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted.get('distance', ())) + 1
+        return offtargets
 
-        yield offtarget_map
-        count += 1
-
-def load_guide_db(samfile):
-    sam_db = pysam.AlignmentFile(samfile, "rb")
+def load_guide_db(samfile, threads=1):
+    sam_db = pysam.AlignmentFile(samfile, "rb", threads=threads)
     genome = sam_db.header['SQ']
     delim = get_nonexist_int_coord(genome)
     return sam_db, delim, genome
 
+def load_decoder(samfile, genome_file, cache_size=0, min_specificity=None, threads=1):
+    """
+    Opens the gRNA database ('-' for a SAM/BAM stream on stdin) and genome,
+    returning the database, a function decoding the off-targets of one of
+    its records and the decoder's off-target cache.
+    """
+    sam_db, _, genome = load_guide_db(samfile, threads)
+    decode_ot, cache = make_decoder(genome, genome_file, cache_size, min_specificity)
+    return sam_db, decode_ot, cache
+
+def make_decoder(genome, genome_file, cache_size=0, min_specificity=None):
+    """
+    Builds the record decoder. With min_specificity, records are only
+    screened against the cutoff by screen_specificity.
+    """
+    delim = get_nonexist_int_coord(genome)
+    offset_index = build_offset_index(genome)
+    packed_genome = pack_genome.open_genome(genome_file)
+    genome_map = map_chroms_to_genome(offset_index[0], packed_genome)
+    if min_specificity is None:
+        decode_record = lambda record: decode_off_targets(
+            record, offset_index, delim, packed_genome, genome_map)
+    else:
+        decode_record = lambda record: screen_specificity(
+            record, offset_index, delim, packed_genome, genome_map, min_specificity)
+    cache = OffTargetCache(cache_size)
+    decode_ot = lambda record: cache.decode(record, decode_record)
+    return decode_ot, cache
+
 def output_complete(offtargets):
-    for i, offtarget in enumerate(offtargets):
-        print(','.join(map(str, [
-            offtarget['identifier'], i, offtarget['offtarget'], offtarget['chr'],
-            offtarget['pos'], offtarget['sense'], offtarget['distance'],
-            offtarget['cfd'] or ''
-        ])))
+    if offtargets is None:
+        return ''
+
+    identifier = offtargets['identifier']
+    chrom_names = offtargets['chrom_names']
+    rows = zip(offtargets['offtarget'], offtargets['chrom_id'].tolist(), offtargets['pos'].tolist(),
+               offtargets['sense'].tolist(), offtargets['distance'].tolist(), offtargets['cfd'].tolist())
+
+    # unscored (NaN) and zero CFDs are both left blank
+    return ''.join(
+        f"{identifier},{i},{offtarget},{chrom_names[chrom_id]},{pos},{sense},{distance},"
+        f"{cfd if cfd == cfd and cfd else ''}\n"
+        for i, (offtarget, chrom_id, pos, sense, distance, cfd) in enumerate(rows)
+    )
 
 def output_succinct(record, offtargets):
     identifier = record.query_name
@@ -160,31 +615,627 @@ def output_succinct(record, offtargets):
     position = record.reference_start
     sense = '-' if record.is_reverse else '+'
 
-    match_counts = [0, 0, 0, 0]
-    cfd_sum = None
-    if offtargets:
-        if all(offtarget['cfd'] is not None for offtarget in offtargets):
-            cfd_sum =  sum((offtarget['cfd'] for offtarget in offtargets))
+    match_counts, specificity = [0, 0, 0, 0], ''
+    if offtargets is not None:
+        match_counts, specificity = offtargets['match_counts'], offtargets['specificity']
 
-        flag = False
+    fields = [identifier, sequence, chrm, position, sense,
+              match_counts[0], match_counts[1], match_counts[2],
+              match_counts[3], specificity]
+    if offtargets is not None and 'passed' in offtargets:
+        fields.append(offtargets['passed'])
 
-        for offtarget in offtargets:
-            match_counts[offtarget['distance']] += 1
+    return ','.join(list(map(str, fields))) + '\n'
 
-            if (offtarget['distance'] == 0 and flag == False and offtarget['cfd'] is not None and cfd_sum is not None):
-                cfd_sum -= offtarget['cfd']
-                flag = True
+def output_record(record, decode_ot, mode, fmt='csv'):
+    """
+    Returns the CSV rows of record, or in complete mode with a columnar
+    format its off-target columns, which ColumnarWriter batches.
+    """
+    PROFILER.count('records')
+    offtargets = decode_ot(record)
+    if offtargets is not None:
+        PROFILER.count('offtargets', sum(offtargets['match_counts']))
+    with PROFILER.stage('output'):
+        if mode == 'succinct':
+            return output_succinct(record, offtargets)
+        elif fmt == 'csv':
+            return output_complete(offtargets)
+        return offtargets
 
-    if cfd_sum:
-        specificity = 1 / (1 + cfd_sum)
-        if cfd_sum == 0:
-            specificity = 1
+class CsvWriter:
+    def __init__(self, path, header):
+        self.out = sys.stdout if path == '-' else open(path, 'w')
+        self.out.write(header + '\n')
+
+    def write(self, outputs):
+        self.out.write(''.join(outputs))
+
+    def flush(self):
+        self.out.flush()
+
+    def close(self):
+        if self.out is sys.stdout:
+            self.out.flush()
+        else:
+            self.out.close()
+
+class ColumnarWriter:
+    """
+    Writes complete-mode off-targets as typed columns in record batches of
+    about batch_rows rows: one row group per batch for Parquet, one record
+    batch per batch for the Arrow IPC file format.
+    """
+    def __init__(self, path, fmt, batch_rows, chrom_names):
+        import pyarrow as pa
+
+        self.pa = pa
+        self.fmt = fmt
+        self.chrom_names = pa.array(chrom_names, type=pa.string())
+        self.batch_rows = batch_rows
+        self.pending, self.pending_rows = [], 0
+        self.schema = pa.schema([
+            ('id', pa.string()),
+            ('match_number', pa.int32()),
+            ('sequence', pa.string()),
+            ('chromosome', pa.dictionary(pa.int32(), pa.string())),
+            ('position', pa.int32()),
+            ('sense', pa.dictionary(pa.int8(), pa.string())),
+            ('distance', pa.int8()),
+            ('cfd', pa.float32()),
+        ])
+
+        if fmt == 'parquet':
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(path, self.schema)
+        elif fmt == 'arrow':
+            self.writer = pa.ipc.new_file(path, self.schema)
+
+    def write(self, outputs):
+        for offtargets in outputs:
+            if offtargets is None or not len(offtargets['distance']):
+                continue
+            self.pending.append(offtargets)
+            self.pending_rows += len(offtargets['distance'])
+            if self.pending_rows >= self.batch_rows:
+                self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        pa = self.pa
+        ots = self.pending
+        lengths = [len(ot['distance']) for ot in ots]
+        cfds = np.concatenate([ot['cfd'] for ot in ots]).astype(np.float32)
+        senses = np.concatenate([ot['sense'] for ot in ots])
+
+        batch = pa.record_batch([
+            pa.array(np.repeat(np.array([ot['identifier'] for ot in ots], dtype=object), lengths),
+                     type=pa.string()),
+            pa.array(np.concatenate([np.arange(n, dtype=np.int32) for n in lengths])),
+            pa.array([seq for ot in ots for seq in ot['offtarget']], type=pa.string()),
+            pa.DictionaryArray.from_arrays(
+                pa.array(np.concatenate([ot['chrom_id'] for ot in ots]).astype(np.int32)),
+                self.chrom_names),
+            pa.array(np.concatenate([ot['pos'] for ot in ots]).astype(np.int32)),
+            pa.DictionaryArray.from_arrays(
+                pa.array((senses == '-').astype(np.int8)), pa.array(['+', '-'])),
+            pa.array(np.concatenate([ot['distance'] for ot in ots]).astype(np.int8)),
+            pa.array(cfds, mask=np.isnan(cfds)),
+        ], schema=self.schema)
+
+        if self.fmt == 'parquet':
+            self.writer.write_batch(batch, row_group_size=len(batch))
+        else:
+            self.writer.write_batch(batch)
+
+        self.pending, self.pending_rows = [], 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+def off_target_intervals(pos, sense, lengths):
+    """
+    0-based, half-open genomic intervals [start, end) covered by off-target
+    windows of the given (possibly truncated) lengths.
+    """
+    start = np.where(sense == '+', pos + 1 - lengths, pos)
+    return start, np.maximum(start + lengths, start + 1)
+
+MAX_OPEN_RUNS = 256
+
+def run_key(line):
+    return line[:21]
+
+class TabixWriter:
+    """
+    Writes complete-mode off-targets as a BGZF-compressed, tabix-indexed
+    TSV sorted by chromosome and start, for region queries with
+    query_offtargets.py. Batches of batch_rows rows are sorted into
+    temporary runs that are merged when the writer is closed, so memory
+    stays bounded by the batch size.
+    """
+    def __init__(self, path, batch_rows, chrom_names):
+        if not path.endswith('.gz'):
+            raise ValueError("--format tabix output must end in .gz")
+        self.path = path
+        self.batch_rows = batch_rows
+        self.chrom_names = chrom_names
+        self.pending, self.pending_rows = [], 0
+        self.tmp_dir = tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path)))
+        self.runs, self.run_count = [], 0
+
+    def new_run(self):
+        self.run_count += 1
+        return os.path.join(self.tmp_dir.name, f'run{self.run_count}.tsv')
+
+    def write(self, outputs):
+        for offtargets in outputs:
+            if offtargets is None or not len(offtargets['distance']):
+                continue
+            self.pending.append(offtargets)
+            self.pending_rows += len(offtargets['distance'])
+            if self.pending_rows >= self.batch_rows:
+                self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        ots = self.pending
+        lengths = [len(ot['distance']) for ot in ots]
+        identifiers = np.repeat(np.array([ot['identifier'] for ot in ots], dtype=object), lengths)
+        match_numbers = np.concatenate([np.arange(n) for n in lengths])
+        seqs = np.array([seq for ot in ots for seq in ot['offtarget']], dtype=object)
+        chrom_ids = np.concatenate([ot['chrom_id'] for ot in ots])
+        pos = np.concatenate([ot['pos'] for ot in ots])
+        sense = np.concatenate([ot['sense'] for ot in ots])
+        distances = np.concatenate([ot['distance'] for ot in ots])
+        cfds = np.concatenate([ot['cfd'] for ot in ots])
+        starts, ends = off_target_intervals(pos, sense, np.array([len(seq) for seq in seqs]))
+
+        # each line carries a fixed-width (chromosome, start) prefix so runs
+        # merge with plain string comparisons; ties keep record order
+        order = np.lexsort((starts, chrom_ids))
+        rows = zip(chrom_ids[order].tolist(), starts[order].tolist(), ends[order].tolist(),
+                   identifiers[order].tolist(), match_numbers[order].tolist(), seqs[order].tolist(),
+                   pos[order].tolist(), sense[order].tolist(), distances[order].tolist(),
+                   cfds[order].tolist())
+
+        run = self.new_run()
+        with open(run, 'w') as f:
+            f.writelines(
+                f"{chrom_id:09d}{start:012d}{self.chrom_names[chrom_id]}\t{start}\t{end}\t{identifier}\t"
+                f"{i}\t{seq}\t{p}\t{strand}\t{distance}\t{cfd if cfd == cfd and cfd else ''}\n"
+                for chrom_id, start, end, identifier, i, seq, p, strand, distance, cfd in rows
+            )
+        self.runs.append(run)
+        self.pending, self.pending_rows = [], 0
+
+    def merge_runs(self, runs, out_path):
+        files = [open(run) for run in runs]
+        with open(out_path, 'w') as out:
+            out.writelines(heapq.merge(*files, key=run_key))
+        for f, run in zip(files, runs):
+            f.close()
+            os.remove(run)
+
+    def close(self):
+        self.flush()
+
+        # keep the number of simultaneously open runs bounded
+        while len(self.runs) > MAX_OPEN_RUNS:
+            merged = self.new_run()
+            self.merge_runs(self.runs[:MAX_OPEN_RUNS], merged)
+            self.runs = [merged] + self.runs[MAX_OPEN_RUNS:]
+
+        runs = [open(run) for run in self.runs]
+        with pysam.BGZFile(self.path, 'wb') as out:
+            out.write((TABIX_HEADER + '\n').encode())
+            block = []
+            for line in heapq.merge(*runs, key=run_key):
+                block.append(line[21:])
+                if len(block) == 65536:
+                    out.write(''.join(block).encode())
+                    block = []
+            out.write(''.join(block).encode())
+        for run in runs:
+            run.close()
+        self.tmp_dir.cleanup()
+
+        pysam.tabix_index(self.path, seq_col=0, start_col=1, end_col=2,
+                          zerobased=True, force=True, meta_char='#')
+
+def open_writer(args, genome):
+    if args.format == 'csv' and args.mode == 'succinct':
+        header = SUCCINCT_HEADER
+        if args.min_specificity is not None:
+            header += ',passes_min_specificity'
+        return CsvWriter(args.output, header)
+    elif args.format == 'csv':
+        return CsvWriter(args.output, COMPLETE_HEADER)
+    elif args.format == 'tabix':
+        return TabixWriter(args.output, args.batch_size, [sq['SN'] for sq in genome])
+    return ColumnarWriter(args.output, args.format, args.batch_size, [sq['SN'] for sq in genome])
+
+##########################
+## Multi-process decode ##
+##########################
+
+WORKER_STATE = {}
+
+def init_worker(args, header=None):
+    """
+    Loads the decoder of a worker process. Workers decoding a stream are
+    handed the stream's header instead of opening the database themselves.
+    """
+    if header is None:
+        sam_db, decode_ot, cache = load_decoder(args.grna_database, args.fasta_file, args.cache_size,
+                                                 args.min_specificity)
+        header = sam_db.header
     else:
-        specificity = ''
+        sam_db = None
+        header = pysam.AlignmentHeader.from_dict(header)
+        decode_ot, cache = make_decoder(header.to_dict()['SQ'], args.fasta_file, args.cache_size,
+                                        args.min_specificity)
+    WORKER_STATE.update(sam_db=sam_db, header=header, decode_ot=decode_ot, cache=cache,
+                        mode=args.mode, format=args.format)
+    PROFILER.enabled = profiling(args)
+
+def decode_batch(records):
+    """
+    Decodes records, returning their outputs, the cache hits and misses
+    they incurred and their profile. CSV rows are joined into a single
+    output.
+    """
+    cache, fmt = WORKER_STATE['cache'], WORKER_STATE['format']
+    hits, misses = cache.hits, cache.misses
+    PROFILER.reset()
+    outputs = [
+        output_record(record, WORKER_STATE['decode_ot'], WORKER_STATE['mode'], fmt)
+        for record in PROFILER.iterate('bam_iteration', records)
+    ]
+    if fmt == 'csv':
+        outputs = [''.join(outputs)]
+    else:
+        # the main process already holds the chromosome names
+        outputs = [ot and {k: v for k, v in ot.items() if k != 'chrom_names'} for ot in outputs]
+    return outputs, cache.hits - hits, cache.misses - misses, PROFILER.snapshot()
+
+def read_ranges(sam_db, ranges):
+    """
+    Yields the records of (virtual offset, count) ranges of sam_db.
+    """
+    for offset, count in ranges:
+        sam_db.seek(offset)
+        for _ in range(count):
+            yield next(sam_db)
+
+def decode_shard(shard):
+    """
+    Decodes a shard given as a list of (virtual offset, count) ranges.
+    """
+    return decode_batch(read_ranges(WORKER_STATE['sam_db'], shard))
+
+def decode_lines(lines):
+    """
+    Decodes a batch of records shipped from a stream as SAM text lines.
+    """
+    header = WORKER_STATE['header']
+    return decode_batch(pysam.AlignedSegment.fromstring(line, header) for line in lines)
+
+def shard_records(sam_db, shard_size):
+    """
+    Splits the records of sam_db into shards of at most shard_size
+    consecutive records.
+    """
+    offset, count = sam_db.tell(), 0
+    for _ in sam_db:
+        count += 1
+        if count == shard_size:
+            yield [(offset, count)]
+            offset, count = sam_db.tell(), 0
+    if count:
+        yield [(offset, count)]
+
+def shard_offsets(offsets, shard_size):
+    """
+    Splits the single records at offsets into shards of shard_size records.
+    """
+    for i in range(0, len(offsets), shard_size):
+        yield [(offset, 1) for offset in offsets[i:i + shard_size]]
+
+def batched(iterable, batch_size):
+    """
+    Splits iterable into lists of at most batch_size items.
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def batch_records(sam_db, batch_size):
+    """
+    Splits a stream into batches of at most batch_size SAM text lines.
+    """
+    return batched((record.to_string() for record in sam_db), batch_size)
+
+def decode_parallel(args):
+    """
+    Decodes args.grna_database across a pool of args.workers workers,
+    writing shards back in record order through the output writer. At most
+    args.queue_depth (default 4 * workers) shards are in flight at once.
+    Returns the total cache hits and misses.
+
+    Files are split into offset ranges that workers read themselves; a
+    stream on stdin cannot be re-read, so its records are shipped to the
+    workers as SAM text in batches of args.shard_size.
+    """
+    # pack the genome once up front so workers only ever memory-map it
+    args.fasta_file = pack_genome.open_genome(args.fasta_file).path
+    sam_db, _, genome = load_guide_db(args.grna_database, args.threads)
+    writer = open_writer(args, genome)
+    # nothing buffered may be inherited by the forked workers
+    writer.flush()
+
+    if args.grna_database == '-':
+        task, shards = decode_lines, batch_records(sam_db, args.shard_size)
+        init_args = (args, sam_db.header.to_dict())
+    elif args.ids:
+        offsets = lookup_offsets(args.grna_database, read_ids(args.ids))
+        task, shards = decode_shard, shard_offsets(offsets, args.shard_size)
+        init_args = (args,)
+    else:
+        task, shards = decode_shard, shard_records(sam_db, args.shard_size)
+        init_args = (args,)
+
+    queue_depth = args.queue_depth or 4 * args.workers
+    if args.pipeline:
+        shards = read_ahead(shards, queue_depth)
+
+    hits, misses = 0, 0
+    progress = ProgressReporter(args.progress)
+    def write(result):
+        nonlocal hits, misses
+        outputs, shard_hits, shard_misses, profile = result.get()
+        with PROFILER.stage('write'):
+            writer.write(outputs)
+            if args.grna_database == '-' and args.format == 'csv':
+                writer.flush()
+        hits, misses = hits + shard_hits, misses + shard_misses
+        PROFILER.merge(profile)
+        progress.update()
+
+    with multiprocessing.Pool(args.workers, init_worker, init_args) as pool:
+        # the writer thread starts after the fork, so workers never inherit it
+        if args.pipeline:
+            writer = ThreadedWriter(writer, args.write_queue_depth)
+        pending = deque()
+        for shard in shards:
+            pending.append(pool.apply_async(task, (shard,)))
+            if len(pending) >= queue_depth:
+                write(pending.popleft())
+        while pending:
+            write(pending.popleft())
+
+    writer.close()
+    return hits, misses
+
+#######################
+## Threaded pipeline ##
+#######################
+
+class ReaderError:
+    def __init__(self, error):
+        self.error = error
+
+def read_ahead(iterable, depth):
+    """
+    Iterates over iterable in a reader thread, keeping at most depth items
+    queued ahead of the consumer so that reading and BGZF decompression
+    overlap with decoding. Errors in the reader are raised in the consumer.
+    """
+    items = queue.Queue(depth)
+    done = object()
+
+    def read():
+        try:
+            for item in iterable:
+                items.put(item)
+        except BaseException as e:
+            items.put(ReaderError(e))
+        else:
+            items.put(done)
+
+    threading.Thread(target=read, daemon=True).start()
+    while True:
+        item = items.get()
+        if item is done:
+            return
+        if isinstance(item, ReaderError):
+            raise item.error
+        yield item
+
+class ThreadedWriter:
+    """
+    Hands writes to a writer thread through a queue of at most depth
+    batches. Batches queued while the thread was busy are coalesced into a
+    single write. Errors in the writer are raised on the next call.
+    """
+    FLUSH = object()
+    CLOSE = object()
+
+    def __init__(self, writer, depth):
+        self.writer = writer
+        self.batches = queue.Queue(depth)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        closing = False
+        while not closing:
+            outputs, flush = [], False
+            item = self.batches.get()
+            while True:
+                if item is self.CLOSE:
+                    closing = True
+                    break
+                elif item is self.FLUSH:
+                    flush = True
+                else:
+                    outputs.extend(item)
+                try:
+                    item = self.batches.get_nowait()
+                except queue.Empty:
+                    break
+
+            if self.error is not None:
+                continue
+            try:
+                if outputs:
+                    self.writer.write(outputs)
+                if flush:
+                    self.writer.flush()
+            except BaseException as e:
+                self.error = e
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def write(self, outputs):
+        self.check()
+        self.batches.put(outputs)
+
+    def flush(self):
+        self.check()
+        self.batches.put(self.FLUSH)
+
+    def close(self):
+        self.batches.put(self.CLOSE)
+        self.thread.join()
+        self.check()
+        self.writer.close()
+
+def profiling(args):
+    return args.profile is not None or args.progress is not None
+
+class ProgressReporter:
+    """
+    Prints a progress line to stderr at most every interval seconds.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.start = self.last = time.perf_counter()
+
+    def update(self):
+        if self.interval is None:
+            return
+        now = time.perf_counter()
+        if now - self.last >= self.interval:
+            self.last = now
+            print(PROFILER.progress(now - self.start), file=sys.stderr, flush=True)
+
+def write_profile(args, wall_time):
+    report = json.dumps(PROFILER.report(wall_time), indent=2)
+    if args.profile == '-':
+        print(report, file=sys.stderr)
+    else:
+        with open(args.profile, 'w') as f:
+            f.write(report + '\n')
+
+#######################
+## Partial re-decode ##
+#######################
 
-    print(','.join(list(map(str, [identifier, sequence, chrm, position, sense,
-                                  match_counts[0], match_counts[1], match_counts[2],
-                                  match_counts[3], specificity]))))
+NAME_INDEX_SUFFIX = '.names.npy'
+
+def build_name_index(samfile, index_file):
+    """
+    Writes the name -> virtual offset side index of samfile: a NumPy record
+    array sorted by name, records sharing a name in record order.
+    """
+    sam_db, _, _ = load_guide_db(samfile)
+    names, offsets = [], []
+    offset = sam_db.tell()
+    for record in sam_db:
+        names.append(record.query_name.encode())
+        offsets.append(offset)
+        offset = sam_db.tell()
+
+    names = np.array(names, dtype=bytes) if names else np.empty(0, dtype='S1')
+    index = np.empty(len(names), dtype=[('name', names.dtype), ('offset', '<u8')])
+    order = np.argsort(names, kind='stable')
+    index['name'] = names[order]
+    index['offset'] = np.array(offsets, dtype=np.uint64)[order]
+
+    tmp_file = index_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        np.save(f, index)
+    os.replace(tmp_file, index_file)
+
+def lookup_offsets(samfile, ids):
+    """
+    Virtual offsets, in record order, of the records named in ids, found by
+    binary search in the memory-mapped side index. The index is built on
+    first use and rebuilt whenever samfile changes.
+    """
+    index_file = samfile + NAME_INDEX_SUFFIX
+    if (not os.path.exists(index_file) or
+        os.path.getmtime(index_file) < os.path.getmtime(samfile)):
+        print(f"Building name index {index_file}", file=sys.stderr)
+        build_name_index(samfile, index_file)
+
+    index = np.load(index_file, mmap_mode='r')
+    ids = sorted(set(ids))
+    # encoded at the index's width, so that longer IDs cannot match a prefix
+    width = index.dtype['name'].itemsize
+    keys = np.array([i.encode() for i in ids if len(i.encode()) <= width], dtype=f'S{width}')
+
+    names = index['name']
+    lo = np.searchsorted(names, keys, side='left')
+    hi = np.searchsorted(names, keys, side='right')
+
+    found = int((hi > lo).sum())
+    if found < len(ids):
+        print(f"{len(ids) - found} of {len(ids)} IDs not found in {samfile}", file=sys.stderr)
+
+    offsets = [int(offset) for l, h in zip(lo, hi) for offset in index['offset'][l:h]]
+    return sorted(offsets)
+
+def read_ids(ids_file):
+    with open(ids_file, 'r') as f:
+        return [line.split()[0] for line in f if line.strip()]
+
+def fetch_regions(sam_db, regions):
+    """
+    Yields the records overlapping each region through the BAM index,
+    reporting records that overlap several regions once.
+    """
+    seen = set()
+    for chrom, start, end in regions:
+        for record in sam_db.fetch(chrom, start, end):
+            key = (record.query_name, record.reference_id, record.reference_start)
+            if key not in seen:
+                seen.add(key)
+                yield record
+
+def select_records(sam_db, args):
+    if args.regions:
+        if not sam_db.has_index():
+            sys.exit(f"--regions requires a coordinate-sorted, indexed BAM ({args.grna_database}.bai)")
+        return fetch_regions(sam_db, query_offtargets.read_bed(args.regions))
+    elif args.ids:
+        offsets = lookup_offsets(args.grna_database, read_ids(args.ids))
+        return read_ranges(sam_db, [(offset, 1) for offset in offsets])
+    return sam_db
 
 def parse_args():
     p = argparse.ArgumentParser(
@@ -193,12 +1244,14 @@ def parse_args():
 
     p.add_argument(
         "grna_database",
-        help="SAM/BAM file containing Guidescan2 processed gRNAs."
+        help=("SAM/BAM file containing Guidescan2 processed gRNAs, or '-' to "
+              "decode a SAM/BAM stream from stdin as it is written.")
     )
 
     p.add_argument(
         "fasta_file",
-        help="FASTA file for resolving off-target sequences."
+        help=("FASTA file for resolving off-target sequences, or a genome packed "
+              "by pack_genome.py. A FASTA file is packed on first use.")
     )
 
     p.add_argument(
@@ -208,26 +1261,174 @@ def parse_args():
         default='succinct'
     )
 
-    return p.parse_args()
+    p.add_argument(
+        "--workers",
+        help="Number of decoding processes.",
+        type=int,
+        default=1
+    )
+
+    p.add_argument(
+        "--shard-size",
+        help="Number of records per shard when decoding with multiple workers or --pipeline.",
+        type=int,
+        default=1000
+    )
+
+    p.add_argument(
+        "--threads",
+        help="BGZF decompression threads for reading the database.",
+        type=int,
+        default=1
+    )
+
+    p.add_argument(
+        "--pipeline",
+        help=("Read records and write output in their own threads, overlapping "
+              "I/O with decoding."),
+        action='store_true'
+    )
+
+    p.add_argument(
+        "--queue-depth",
+        help=("Batches of --shard-size records queued ahead of decoding (default: "
+              "4, or 4 * workers shards in flight with --workers)."),
+        type=int
+    )
+
+    p.add_argument(
+        "--write-queue-depth",
+        help="Output batches queued for the writer thread with --pipeline.",
+        type=int,
+        default=16
+    )
+
+    p.add_argument(
+        "--cache-size",
+        help=("Maximum number of decoded off-targets kept in the duplicate guide "
+              "cache (per worker). 0 disables the cache."),
+        type=int,
+        default=1_000_000
+    )
+
+    p.add_argument(
+        "--format",
+        help=("Output format. Parquet and Arrow (IPC file) write typed, batched "
+              "columns; tabix writes a coordinate-sorted, BGZF-compressed and "
+              "tabix-indexed TSV for query_offtargets.py. All but CSV are only "
+              "available in complete mode."),
+        choices=['csv', 'parquet', 'arrow', 'tabix'],
+        default='csv'
+    )
+
+    p.add_argument(
+        "--batch-size",
+        help="Rows per Parquet row group / Arrow record batch / tabix sort run.",
+        type=int,
+        default=1_000_000
+    )
+
+    p.add_argument(
+        "-o", "--output",
+        help="Output file, '-' for stdout (CSV only).",
+        default='-'
+    )
+
+    selection = p.add_mutually_exclusive_group()
+
+    selection.add_argument(
+        "--regions",
+        help=("BED file of regions; only decode the gRNAs in them, fetched through "
+              "the index of a coordinate-sorted BAM.")
+    )
+
+    selection.add_argument(
+        "--ids",
+        help=("File listing gRNA IDs, one per line; only decode those gRNAs, found "
+              f"through a name index built next to the database ({NAME_INDEX_SUFFIX})."),
+    )
+
+    p.add_argument(
+        "--min-specificity",
+        help=("Succinct mode: only screen guides against this specificity cutoff, "
+              "stopping as soon as a guide is known to fall below it. Adds a "
+              "passes_min_specificity column; failed guides have no specificity."),
+        type=float
+    )
+
+    p.add_argument(
+        "--profile",
+        help=("Record wall time and call counts per decoding stage, off-targets "
+              "per second and peak RSS, and write them as JSON to PROFILE at exit "
+              "(stderr if no file is given)."),
+        nargs='?',
+        const='-'
+    )
+
+    p.add_argument(
+        "--progress",
+        help="Print a progress line to stderr every PROGRESS seconds.",
+        type=float
+    )
+
+    args = p.parse_args()
+    if args.format != 'csv' and args.mode != 'complete':
+        p.error(f"--format {args.format} requires --mode complete")
+    if args.min_specificity is not None and args.mode != 'succinct':
+        p.error("--min-specificity requires --mode succinct")
+    if args.min_specificity is not None and not 0 < args.min_specificity <= 1:
+        p.error("--min-specificity must lie in (0, 1]")
+    if (args.regions or args.ids) and args.grna_database == '-':
+        p.error("--regions and --ids cannot be used on a stream")
+    if args.regions and args.workers > 1:
+        p.error("--regions is decoded serially; use --ids to re-decode in parallel")
+    if args.format != 'csv' and args.output == '-':
+        p.error(f"--format {args.format} requires an output file (-o)")
+    if args.queue_depth is not None and args.queue_depth < 1:
+        p.error("--queue-depth must be at least 1")
+    if args.write_queue_depth < 1:
+        p.error("--write-queue-depth must be at least 1")
+    return args
 
 SUCCINCT_HEADER = ('id,sequence,chromosome,position,sense,'
                    'distance_0_matches,distance_1_matches,'
                    'distance_2_matches,distance_3_matches,'
                    'specificity')
 COMPLETE_HEADER = ('id,match_number,sequence,chromosome,position,sense,distance,cfd')
+TABIX_HEADER = ('#chromosome\tstart\tend\tid\tmatch_number\tsequence\t'
+                'position\tsense\tdistance\tcfd')
 
 if __name__ == "__main__":
     args = parse_args()
 
-    sam_db, delim, genome = load_guide_db(args.grna_database)
-    fasta_dict = SeqIO.to_dict(SeqIO.parse(args.fasta_file, "fasta"))
-    decode_ot = lambda record: decode_off_targets(record, genome, delim, fasta_dict)
-
-    if args.mode == 'succinct':
-        print(SUCCINCT_HEADER)
-        for sam_record in sam_db:
-            output_succinct(sam_record, list(decode_ot(sam_record)))
-    elif args.mode == 'complete':
-        print(COMPLETE_HEADER)
-        for sam_record in sam_db:
-            output_complete(decode_ot(sam_record))
+    PROFILER.enabled = profiling(args)
+    start = time.perf_counter()
+
+    if args.workers > 1:
+        hits, misses = decode_parallel(args)
+    else:
+        sam_db, decode_ot, cache = load_decoder(args.grna_database, args.fasta_file, args.cache_size,
+                                                 args.min_specificity, args.threads)
+        writer = open_writer(args, sam_db.header['SQ'])
+        records = select_records(sam_db, args)
+        if args.pipeline:
+            writer = ThreadedWriter(writer, args.write_queue_depth)
+            batches = read_ahead(batched(records, args.shard_size), args.queue_depth or 4)
+        else:
+            batches = ([record] for record in records)
+
+        progress = ProgressReporter(args.progress)
+        for batch in PROFILER.iterate('bam_iteration', batches):
+            outputs = [output_record(record, decode_ot, args.mode, args.format) for record in batch]
+            with PROFILER.stage('write'):
+                writer.write(outputs)
+            progress.update()
+        with PROFILER.stage('write'):
+            writer.close()
+        hits, misses = cache.hits, cache.misses
+
+    if args.cache_size > 0:
+        print(f"Off-target cache: {hits} hits, {misses} misses", file=sys.stderr)
+
+    if args.profile is not None:
+        write_profile(args, time.perf_counter() - start)
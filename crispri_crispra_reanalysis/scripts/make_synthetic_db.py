@@ -0,0 +1,188 @@
+"""
+Builds a random reference genome and a matching Guidescan2-style gRNA
+database for benchmarking decode_sam.py without a real genome index.
+
+Every record is a guide sampled from the genome, tagged with an `of`
+payload listing its own site at distance 0 followed by random off-target
+sites at distances 0..--max-distance, in the layout written by
+`guidescan enumerate`.
+"""
+
+import argparse
+import binascii
+
+import numpy as np
+import pysam
+
+from decode_sam import get_nonexist_int_coord
+
+NUCLEOTIDES = np.frombuffer(b'ACGT', dtype=np.uint8)
+LINE_WIDTH = 60
+
+def random_genome(rng, genome_size, contigs):
+    """
+    Returns contig lengths and an array of ASCII bases. Contig lengths are
+    drawn uniformly between half and one and a half times the mean.
+    """
+    weights = rng.uniform(0.5, 1.5, contigs)
+    lengths = np.maximum((weights / weights.sum() * genome_size).astype(np.int64), 100)
+    bases = NUCLEOTIDES[rng.integers(0, 4, lengths.sum())]
+    return lengths, bases
+
+def write_fasta(fasta_file, names, lengths, bases):
+    offsets = np.cumsum(lengths) - lengths
+    with open(fasta_file, 'wb') as f:
+        for name, offset, length in zip(names, offsets, lengths):
+            f.write(f'>{name}\n'.encode())
+            seq = bases[offset:offset + length].tobytes()
+            for i in range(0, length, LINE_WIDTH):
+                f.write(seq[i:i + LINE_WIDTH] + b'\n')
+
+def offtarget_counts(rng, distribution, mean, size):
+    if distribution == 'fixed':
+        return np.full(size, int(round(mean)), dtype=np.int64)
+    elif distribution == 'poisson':
+        return rng.poisson(mean, size)
+    elif distribution == 'geometric':
+        return rng.geometric(1 / (mean + 1), size) - 1
+    # heavy tailed, most guides have few off-targets and a handful thousands
+    return np.floor(rng.pareto(1.5, size) * mean * 0.5).astype(np.int64)
+
+def offtarget_payload(rng, own_site, counts, total_length, length, delim):
+    """
+    Hex `of` payload with the guide's own site at distance 0 and counts[d]
+    random sites at each distance d.
+    """
+    groups = []
+    for distance, count in enumerate(counts):
+        positions = rng.integers(length, total_length - length, count)
+        positions = np.where(rng.random(count) < 0.5, positions, -positions)
+        if distance == 0:
+            positions = np.concatenate([[own_site], positions])
+        elif count == 0:
+            continue
+        groups.append(np.concatenate([positions, [distance, delim]]))
+    return binascii.hexlify(np.concatenate(groups).astype('<i8').tobytes()).decode()
+
+def write_database(bam_file, rng, names, lengths, bases, args):
+    header = {
+        'HD': {'VN': '1.0', 'SO': 'unsorted'},
+        'SQ': [{'SN': name, 'LN': int(length)} for name, length in zip(names, lengths)]
+    }
+    delim = get_nonexist_int_coord(header['SQ'])
+    offsets = np.cumsum(lengths) - lengths
+    total_length = int(lengths.sum())
+    length = args.guide_length + 3
+
+    mean = args.mean_offtargets / (args.max_distance + 1)
+    counts = offtarget_counts(rng, args.distribution, mean, (args.records, args.max_distance + 1))
+    chrom_ids = rng.integers(0, len(lengths), args.records)
+    starts = (rng.random(args.records) * (lengths[chrom_ids] - length)).astype(np.int64)
+    duplicates = rng.random(args.records) < args.duplicate_fraction
+
+    with pysam.AlignmentFile(bam_file, 'wb', header=header) as out:
+        payloads = []
+        for i in range(args.records):
+            if duplicates[i] and payloads:
+                j = rng.integers(0, len(payloads))
+                chrom_id, start, payload = payloads[j]
+            else:
+                chrom_id, start = int(chrom_ids[i]), int(starts[i])
+                own_site = int(offsets[chrom_id]) + start + length - 1
+                payload = offtarget_payload(rng, own_site, counts[i], total_length, length, delim)
+                payloads.append((chrom_id, start, payload))
+
+            record = pysam.AlignedSegment()
+            record.query_name = f'guide_{i}'
+            seq = bases[offsets[chrom_id] + start:offsets[chrom_id] + start + length].tobytes()
+            record.query_sequence = seq.decode()
+            record.flag = 0
+            record.reference_id = chrom_id
+            record.reference_start = start
+            record.mapping_quality = 255
+            record.cigarstring = f'{length}M'
+            record.set_tag('of', payload)
+            out.write(record)
+
+def parse_args():
+    p = argparse.ArgumentParser(
+        description="Generates a random genome (PREFIX.fa) and a Guidescan2-style gRNA database (PREFIX.bam)."
+    )
+
+    p.add_argument(
+        "prefix",
+        help="Output prefix."
+    )
+
+    p.add_argument(
+        "--genome-size",
+        help="Total genome length in bases.",
+        type=int,
+        default=10_000_000
+    )
+
+    p.add_argument(
+        "--contigs",
+        help="Number of contigs.",
+        type=int,
+        default=24
+    )
+
+    p.add_argument(
+        "--records",
+        help="Number of gRNA records.",
+        type=int,
+        default=10_000
+    )
+
+    p.add_argument(
+        "--guide-length",
+        help="Protospacer length, excluding the PAM.",
+        type=int,
+        default=20
+    )
+
+    p.add_argument(
+        "--mean-offtargets",
+        help="Mean number of off-targets per guide, besides its own site.",
+        type=float,
+        default=50
+    )
+
+    p.add_argument(
+        "--distribution",
+        help="Distribution of the off-target count at each distance.",
+        choices=['fixed', 'poisson', 'geometric', 'pareto'],
+        default='geometric'
+    )
+
+    p.add_argument(
+        "--max-distance",
+        help="Largest off-target distance (mismatches).",
+        type=int,
+        default=3
+    )
+
+    p.add_argument(
+        "--duplicate-fraction",
+        help="Fraction of records repeating an earlier guide under a new ID, as in screen libraries.",
+        type=float,
+        default=0.0
+    )
+
+    p.add_argument(
+        "--seed",
+        type=int,
+        default=0
+    )
+
+    return p.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    rng = np.random.default_rng(args.seed)
+
+    names = [f'chr{i + 1}' for i in range(args.contigs)]
+    lengths, bases = random_genome(rng, args.genome_size, args.contigs)
+    write_fasta(args.prefix + '.fa', names, lengths, bases)
+    write_database(args.prefix + '.bam', rng, names, lengths, bases, args)
@@ -0,0 +1,276 @@
+"""
+On-disk 2-bit packed genome used by decode_sam.py to resolve off-target
+sequences without parsing the FASTA.
+
+File layout (all integers little-endian):
+
+    MAGIC
+    packed bases   -- 4 bases per byte, A=0 C=1 G=2 T=3, low bits first
+    N-mask         -- 1 bit per base (np.packbits, little bit order), set
+                      for every base that is not A/C/G/T
+    JSON index     -- {"names": [...], "lengths": [...], "seq_start": int,
+                       "mask_start": int, "total_length": int}
+    uint64 length of the JSON index
+    MAGIC
+
+Contigs are concatenated in FASTA order. Bases are stored upper-cased and
+every non-ACGT character (N and IUPAC ambiguity codes) decodes as N.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import struct
+import sys
+import tempfile
+
+import numpy as np
+
+MAGIC = b'GS2PACK1'
+PACKED_SUFFIX = '.packed'
+
+DECODE_TABLE = np.frombuffer(b'ACGTN', dtype=np.uint8)
+COMPLEMENT_CODES = np.array([3, 2, 1, 0, 4], dtype=np.uint8)
+
+ENCODE_TABLE = np.full(256, 4, dtype=np.uint8)
+for code, nuc in enumerate('ACGT'):
+    ENCODE_TABLE[ord(nuc)] = code
+    ENCODE_TABLE[ord(nuc.lower())] = code
+
+CHUNK_SIZE = 1 << 22
+
+def read_fasta_chunks(fasta_file):
+    """
+    Streams a FASTA file as (name, bytes chunk) pairs, a contig at a time,
+    without holding whole contigs in memory. A chunk with name but empty
+    bytes marks the start of each contig.
+    """
+    with open(fasta_file, 'rb') as f:
+        buf, size = [], 0
+        name = None
+        for line in f:
+            if line.startswith(b'>'):
+                if name is not None and buf:
+                    yield name, b''.join(buf)
+                name = (line[1:].split() or [b''])[0].decode()
+                buf, size = [], 0
+                yield name, b''
+                continue
+
+            line = line.rstrip()
+            buf.append(line)
+            size += len(line)
+            if size >= CHUNK_SIZE:
+                yield name, b''.join(buf)
+                buf, size = [], 0
+
+        if name is not None and buf:
+            yield name, b''.join(buf)
+
+class BitWriter:
+    """
+    Packs a stream of small integer codes into a file, carrying the bases
+    that do not fill a whole byte over to the next write.
+    """
+    def __init__(self, f, bits):
+        self.f = f
+        self.bits = bits
+        self.per_byte = 8 // bits
+        self.carry = np.empty(0, dtype=np.uint8)
+
+    def write(self, values):
+        values = np.concatenate([self.carry, values])
+        n = len(values) - len(values) % self.per_byte
+        self.f.write(self.pack(values[:n]))
+        self.carry = values[n:]
+
+    def flush(self):
+        if len(self.carry):
+            pad = np.zeros(self.per_byte - len(self.carry), dtype=np.uint8)
+            self.f.write(self.pack(np.concatenate([self.carry, pad])))
+            self.carry = np.empty(0, dtype=np.uint8)
+
+    def pack(self, values):
+        if self.bits == 1:
+            return np.packbits(values, bitorder='little').tobytes()
+        shifts = np.arange(self.per_byte, dtype=np.uint8) * self.bits
+        groups = values.reshape(-1, self.per_byte) << shifts
+        return np.bitwise_or.reduce(groups, axis=1).astype(np.uint8).tobytes()
+
+def pack_fasta(fasta_file, packed_file):
+    """
+    Converts fasta_file into a packed genome. The file is written under a
+    temporary name and renamed into place, so concurrent readers never see
+    a partial genome.
+    """
+    out_dir = os.path.dirname(os.path.abspath(packed_file))
+    names, lengths = [], []
+
+    with tempfile.NamedTemporaryFile(dir=out_dir, delete=False) as out, \
+         tempfile.TemporaryFile(dir=out_dir) as mask_file:
+        try:
+            out.write(MAGIC)
+            seq_writer = BitWriter(out, 2)
+            mask_writer = BitWriter(mask_file, 1)
+
+            for name, chunk in read_fasta_chunks(fasta_file):
+                if not chunk:
+                    names.append(name)
+                    lengths.append(0)
+                    continue
+                codes = ENCODE_TABLE[np.frombuffer(chunk, dtype=np.uint8)]
+                seq_writer.write(codes & 3)
+                mask_writer.write((codes == 4).astype(np.uint8))
+                lengths[-1] += len(codes)
+
+            seq_writer.flush()
+            mask_writer.flush()
+
+            mask_start = out.tell()
+            mask_file.seek(0)
+            while True:
+                block = mask_file.read(CHUNK_SIZE)
+                if not block:
+                    break
+                out.write(block)
+
+            index = json.dumps({
+                'names': names,
+                'lengths': lengths,
+                'seq_start': len(MAGIC),
+                'mask_start': mask_start,
+                'total_length': sum(lengths),
+            }).encode()
+            out.write(index)
+            out.write(struct.pack('<Q', len(index)))
+            out.write(MAGIC)
+        except BaseException:
+            out.close()
+            os.unlink(out.name)
+            raise
+
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(out.name, 0o666 & ~umask)
+    os.replace(out.name, packed_file)
+
+def is_packed_genome(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+class PackedGenome:
+    """
+    Read-only, memory-mapped view of a packed genome. Every process that
+    opens the same file shares its pages through the OS page cache.
+    """
+    def __init__(self, packed_file):
+        self.path = packed_file
+        data = np.memmap(packed_file, dtype=np.uint8, mode='r')
+
+        index_length = struct.unpack('<Q', data[-16:-8].tobytes())[0]
+        if data[:8].tobytes() != MAGIC or data[-8:].tobytes() != MAGIC:
+            raise ValueError(f"{packed_file} is not a packed genome")
+        index = json.loads(data[-16 - index_length:-16].tobytes())
+
+        self.names = index['names']
+        self.lengths = np.array(index['lengths'], dtype=np.int64)
+        self.offsets = np.cumsum(self.lengths) - self.lengths
+        self.ids = {name: i for i, name in enumerate(self.names)}
+        self.seq = data[index['seq_start']:index['mask_start']]
+        self.mask = data[index['mask_start']:-16 - index_length]
+
+    def codes_at(self, idx):
+        """
+        Nucleotide codes (A=0 C=1 G=2 T=3 N=4) at absolute positions idx.
+        """
+        codes = (self.seq[idx >> 2] >> ((idx & 3) << 1).astype(np.uint8)) & 3
+        is_n = (self.mask[idx >> 3] >> (idx & 7).astype(np.uint8)) & 1
+        codes[is_n.astype(bool)] = 4
+        return codes
+
+    def fetch_windows(self, chrom_ids, starts, length):
+        """
+        Gathers the (n, length) code matrix of windows [start, start + length)
+        on the given contigs in one vectorized operation. Windows must lie
+        entirely inside their contig.
+        """
+        idx = (self.offsets[chrom_ids] + starts)[:, None] + np.arange(length, dtype=np.int64)
+        return self.codes_at(idx)
+
+    def fetch(self, chrom_id, start, end):
+        """
+        Codes of chrom[start:end] with Python slice semantics, so negative
+        and out of range bounds behave exactly as they would on a str.
+        """
+        r = range(int(self.lengths[chrom_id]))[start:end]
+        idx = np.arange(r.start, r.stop, dtype=np.int64) + self.offsets[chrom_id]
+        return self.codes_at(idx)
+
+def decode_codes(codes):
+    """
+    Decodes an (n, length) code matrix into a list of n strings.
+    """
+    codes = np.ascontiguousarray(codes)
+    if codes.shape[1] == 0:
+        return [''] * codes.shape[0]
+    rows = DECODE_TABLE[codes].view(f'S{codes.shape[1]}').ravel()
+    return [row.decode() for row in rows.tolist()]
+
+def cached_packed_file(path):
+    """
+    Where a FASTA file is packed when its own directory is not writable,
+    such as a shared read-only reference: the user cache, under a name
+    unique to the FASTA's absolute path.
+    """
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    key = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, 'guidescan2-analysis', f'{key}-{os.path.basename(path)}{PACKED_SUFFIX}')
+
+def open_genome(path):
+    """
+    Opens path as a packed genome. A FASTA file is packed once into
+    path + PACKED_SUFFIX, or into the user cache if that cannot be written,
+    and reused until the FASTA changes.
+    """
+    if is_packed_genome(path):
+        return PackedGenome(path)
+
+    packed_files = [path + PACKED_SUFFIX, cached_packed_file(path)]
+    for packed_file in packed_files:
+        if os.path.exists(packed_file) and os.path.getmtime(packed_file) >= os.path.getmtime(path):
+            return PackedGenome(packed_file)
+
+    for packed_file in packed_files:
+        print(f"Packing {path} into {packed_file}", file=sys.stderr)
+        try:
+            os.makedirs(os.path.dirname(packed_file), exist_ok=True)
+            pack_fasta(path, packed_file)
+        except OSError as e:
+            print(f"Cannot write {packed_file}: {e}", file=sys.stderr)
+            continue
+        return PackedGenome(packed_file)
+
+    sys.exit(f"Cannot pack {path} next to it or in the user cache. Pack it somewhere "
+             f"writable with `pack_genome.py {path} -o PACKED` and pass PACKED instead.")
+
+def parse_args():
+    p = argparse.ArgumentParser(
+        description="Converts a FASTA genome into the memory-mapped 2-bit packed format used by decode_sam.py."
+    )
+
+    p.add_argument(
+        "fasta_file",
+        help="FASTA file to pack."
+    )
+
+    p.add_argument(
+        "-o", "--output",
+        help=f"Output file (default: FASTA_FILE{PACKED_SUFFIX})."
+    )
+
+    return p.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    pack_fasta(args.fasta_file, args.output or args.fasta_file + PACKED_SUFFIX)
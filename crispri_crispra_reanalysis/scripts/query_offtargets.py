@@ -0,0 +1,88 @@
+import argparse
+import re
+import sys
+
+import pysam
+
+def parse_region(region):
+    """
+    Parses chrom, chrom:start-end or chrom:pos (1-based, inclusive) into a
+    0-based, half-open (chrom, start, end).
+    """
+    m = re.fullmatch(r'(?P<chrom>.+?)(:(?P<start>[\d,]+)(-(?P<end>[\d,]+))?)?', region)
+    if m is None:
+        raise ValueError(f"Invalid region {region}")
+
+    chrom = m.group('chrom')
+    if m.group('start') is None:
+        return chrom, None, None
+
+    start = int(m.group('start').replace(',', ''))
+    end = int(m.group('end').replace(',', '')) if m.group('end') else start
+    return chrom, start - 1, end
+
+def read_bed(bed_file):
+    with open(bed_file, 'r') as f:
+        for line in f:
+            if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                continue
+            fields = line.split()
+            yield fields[0], int(fields[1]), int(fields[2])
+
+def query_regions(offtargets, regions):
+    """
+    Yields the rows of every off-target overlapping each region. Rows
+    overlapping several regions are reported once per region.
+    """
+    contigs = set(offtargets.contigs)
+    for chrom, start, end in regions:
+        if chrom not in contigs:
+            continue
+        yield from offtargets.fetch(chrom, start, end)
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description=("Returns the off-targets overlapping genomic regions from "
+                     "the tabix-indexed output of decode_sam.py --format tabix.")
+    )
+
+    parser.add_argument(
+        "offtargets", help="BGZF-compressed, tabix-indexed off-target TSV."
+    )
+
+    parser.add_argument(
+        "regions", nargs='*',
+        help="Regions as chrom, chrom:pos or chrom:start-end (1-based, inclusive)."
+    )
+
+    parser.add_argument(
+        "--bed", help="BED file of additional regions."
+    )
+
+    parser.add_argument(
+        "--ids", action='store_true',
+        help="Only list the distinct guide IDs with an off-target in the regions."
+    )
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    regions = [parse_region(region) for region in args.regions]
+    if args.bed:
+        regions += list(read_bed(args.bed))
+
+    offtargets = pysam.TabixFile(args.offtargets)
+
+    if args.ids:
+        seen = set()
+        for row in query_regions(offtargets, regions):
+            identifier = row.split('\t', 4)[3]
+            if identifier not in seen:
+                seen.add(identifier)
+                print(identifier)
+    else:
+        print(','.join(offtargets.header[-1].lstrip('#').split('\t')))
+        for row in query_regions(offtargets, regions):
+            sys.stdout.write(row.replace('\t', ',') + '\n')
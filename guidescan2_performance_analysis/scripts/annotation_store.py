@@ -0,0 +1,236 @@
+"""
+Columnar, memory-mappable store of genome annotations, compiled once from a
+GFF3 file or a gffutils database. Each feature is one row of NumPy arrays
+(type, seqid, start, end, strand, gene, ID), with the strings kept in
+per-column string pools. Type filtering, sampling and interval overlap are
+array operations instead of SQLite queries and Feature objects.
+
+    python annotation_store.py annotations.db  # writes annotations.db.store/
+"""
+
+import argparse
+import collections
+import gzip
+import json
+import os
+import sqlite3
+import urllib.parse
+
+import numpy as np
+
+STRING_COLUMNS = ["featuretype", "seqid", "gene", "id"]
+
+Region = collections.namedtuple("Region", ["id", "featuretype", "seqid", "start", "end", "strand", "gene"])
+
+class StringPool:
+    """
+    Strings stored as one UTF-8 blob and their offsets into it.
+    """
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    @classmethod
+    def build(cls, strings):
+        encoded = [s.encode() for s in strings]
+        blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        offsets = np.cumsum([0] + [len(s) for s in encoded], dtype=np.int64)
+        return cls(blob, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, code):
+        return self.blob[self.offsets[code]:self.offsets[code + 1]].tobytes().decode()
+
+    def strings(self):
+        return [self[code] for code in range(len(self))]
+
+def gff_attributes(field):
+    attributes = {}
+    for item in field.strip().split(";"):
+        if "=" in item:
+            key, value = item.split("=", 1)
+            attributes[urllib.parse.unquote(key.strip())] = [
+                urllib.parse.unquote(v) for v in value.split(",")
+            ]
+    return attributes
+
+def read_gff(gff_file):
+    """
+    Yields (featuretype, seqid, start, end, strand, gene, id) of every
+    feature of a GFF3 file, plain or gzipped.
+    """
+    opener = gzip.open if gff_file.endswith(".gz") else open
+    with opener(gff_file, "rt") as f:
+        for line in f:
+            if line.startswith("##FASTA"):
+                break
+            if line.startswith("#") or not line.strip():
+                continue
+
+            seqid, _, featuretype, start, end, _, strand, _, attributes = line.rstrip("\n").split("\t")
+            attributes = gff_attributes(attributes)
+            yield (featuretype, seqid, int(start), int(end), strand,
+                   attributes.get("gene", [""])[0], attributes.get("ID", [""])[0])
+
+def read_gffutils_db(db_file):
+    """
+    Same as read_gff, for a gffutils database; reads its features table
+    directly rather than through Feature objects.
+    """
+    with sqlite3.connect(f"file:{db_file}?mode=ro", uri=True) as conn:
+        rows = conn.execute("SELECT featuretype, seqid, start, end, strand, attributes, id FROM features")
+        for featuretype, seqid, start, end, strand, attributes, feature_id in rows:
+            gene = json.loads(attributes).get("gene", [""]) if attributes else [""]
+            yield featuretype, seqid, start, end, strand, gene[0] if gene else "", feature_id
+
+def is_sqlite(path):
+    with open(path, "rb") as f:
+        return f.read(16) == b"SQLite format 3\x00"
+
+def compile_store(annotation_file, store_dir):
+    """
+    Compiles a GFF3 file or gffutils database into store_dir. Rows are
+    sorted by seqid and start; max_end is the running maximum of end within
+    each seqid, which makes overlap queries a binary search.
+    """
+    features = read_gffutils_db if is_sqlite(annotation_file) else read_gff
+    columns = list(zip(*features(annotation_file))) or [()] * 7
+    featuretype, seqid, start, end, strand, gene, feature_id = columns
+
+    arrays, pools = {}, {}
+    for name, values in zip(STRING_COLUMNS, [featuretype, seqid, gene, feature_id]):
+        pool = {}
+        arrays[name] = np.array([pool.setdefault(v, len(pool)) for v in values], dtype=np.int32)
+        pools[name] = StringPool.build(pool)
+    arrays["start"] = np.array(start, dtype=np.int64)
+    arrays["end"] = np.array(end, dtype=np.int64)
+    arrays["strand"] = np.array([s.encode() for s in strand], dtype="S1")
+
+    order = np.lexsort([arrays["start"], arrays["seqid"]])
+    arrays = {name: column[order] for name, column in arrays.items()}
+
+    seqid_bounds = np.searchsorted(arrays["seqid"], np.arange(len(pools["seqid"]) + 1))
+    max_end = np.empty_like(arrays["end"])
+    for lo, hi in zip(seqid_bounds[:-1], seqid_bounds[1:]):
+        max_end[lo:hi] = np.maximum.accumulate(arrays["end"][lo:hi])
+    arrays["max_end"] = max_end
+    arrays["seqid_bounds"] = seqid_bounds
+
+    os.makedirs(store_dir, exist_ok=True)
+    for name, column in arrays.items():
+        np.save(os.path.join(store_dir, f"{name}.npy"), column)
+    for name, pool in pools.items():
+        np.save(os.path.join(store_dir, f"{name}_pool.npy"), pool.blob)
+        np.save(os.path.join(store_dir, f"{name}_pool_offsets.npy"), pool.offsets)
+
+class AnnotationStore:
+    """
+    Read-only view of a compiled store, with every column memory-mapped.
+    """
+
+    def __init__(self, store_dir):
+        def load(name):
+            return np.load(os.path.join(store_dir, f"{name}.npy"), mmap_mode="r")
+
+        self.columns = {
+            name: load(name)
+            for name in STRING_COLUMNS + ["start", "end", "strand", "max_end", "seqid_bounds"]
+        }
+        self.pools = {
+            name: StringPool(load(f"{name}_pool"), load(f"{name}_pool_offsets"))
+            for name in STRING_COLUMNS
+        }
+        # types and seqids are few, so their codes are looked up by name
+        self.codes = {
+            name: {s: code for code, s in enumerate(self.pools[name].strings())}
+            for name in ["featuretype", "seqid"]
+        }
+
+    @classmethod
+    def open(cls, annotation_file):
+        """
+        Opens a compiled store, or the store next to a GFF3 file or gffutils
+        database, compiling it first if missing or out of date.
+        """
+        if os.path.isdir(annotation_file):
+            return cls(annotation_file)
+
+        store_dir = annotation_file + ".store"
+        # the last file compile_store writes
+        marker = os.path.join(store_dir, f"{STRING_COLUMNS[-1]}_pool_offsets.npy")
+        if not os.path.exists(marker) or os.path.getmtime(marker) < os.path.getmtime(annotation_file):
+            compile_store(annotation_file, store_dir)
+        return cls(store_dir)
+
+    def __len__(self):
+        return len(self.columns["start"])
+
+    def of_type(self, featuretype):
+        """
+        Rows of every feature of featuretype.
+        """
+        code = self.codes["featuretype"].get(featuretype)
+        if code is None:
+            return np.empty(0, dtype=np.int64)
+        return np.flatnonzero(self.columns["featuretype"] == code)
+
+    def sample(self, featuretype, n, rng):
+        """
+        n rows drawn without replacement from the features of featuretype.
+        """
+        return rng.choice(self.of_type(featuretype), n, replace=False)
+
+    def overlapping(self, seqid, start, end, featuretype=None):
+        """
+        Rows of the features on seqid overlapping [start, end], in start
+        order, optionally only those of featuretype.
+        """
+        code = self.codes["seqid"].get(seqid)
+        if code is None:
+            return np.empty(0, dtype=np.int64)
+
+        bounds = self.columns["seqid_bounds"]
+        lo, hi = bounds[code], bounds[code + 1]
+        first = lo + np.searchsorted(self.columns["max_end"][lo:hi], start, side="left")
+        last = lo + np.searchsorted(self.columns["start"][lo:hi], end, side="right")
+
+        rows = first + np.flatnonzero(self.columns["end"][first:last] >= start)
+        if featuretype is not None:
+            rows = rows[self.columns["featuretype"][rows] == self.codes["featuretype"].get(featuretype, -1)]
+        return rows
+
+    def regions(self, rows):
+        """
+        Regions of rows, with the fields of the gffutils Features they replace.
+        """
+        featuretype, seqid, start, end, strand, gene, feature_id = (
+            self.columns[name][rows]
+            for name in ["featuretype", "seqid", "start", "end", "strand", "gene", "id"]
+        )
+        types, seqids = self.pools["featuretype"].strings(), self.pools["seqid"].strings()
+        return [
+            Region(self.pools["id"][i], types[t], seqids[c], int(s), int(e), d.decode(), self.pools["gene"][g])
+            for i, t, c, s, e, d, g in zip(feature_id, featuretype, seqid, start, end, strand, gene)
+        ]
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Compiles a GFF3 file or gffutils database into a columnar annotation store."
+    )
+
+    parser.add_argument(
+        "annotations", help="GFF3 file (optionally gzipped) or gffutils database."
+    )
+
+    parser.add_argument(
+        "-o", help="Output directory (default: ANNOTATIONS.store)."
+    )
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    compile_store(args.annotations, args.o or args.annotations + ".store")
@@ -1,19 +1,19 @@
-from Bio import SeqIO
-
 import random
-import gffutils
+import hashlib
+import itertools
+import multiprocessing
 import os
 import pandas as pd
 import numpy as np
 import argparse
 
+from annotation_store import AnnotationStore
+from indexed_fasta import IndexedFasta, load_fai
+from random_guides import random_guide_chunks, write_random_guides
+
 NUCS = list("ACTG")
 NUC_MAP = {"A": "T", "T": "A", "C": "G", "G": "C"}
 
-def uniformly_random_guides(n, k = 20):
-    for _ in range(n):
-        yield "".join(random.sample(NUCS, 1)[0] for _ in range(k))
-
 def revcom(dna):
     return "".join(list(map(lambda n: NUC_MAP[n], list(dna)))[::-1])
 
@@ -32,57 +32,204 @@ def generate_pam_set(pam):
 
     return pam_stack
 
-def get_guides_across_region(chrm, start, end, pam, k=20, forward=True):
-    index = start
-
-    while True:
-        index = chrm.find(pam, index)
-
-        if index == -1 or index > end:
-            break 
-
-        if forward:
-            kmer = chrm[index - k:index]
-            position = index - k
-        else:
-            kmer = chrm[index + len(pam):index + k + len(pam)]
-            position = index
-
-        index += 1
+def sequence_codes(seq):
+    if isinstance(seq, str):
+        seq = seq.encode()
+    return np.frombuffer(bytes(seq), dtype=np.uint8)
+
+PAM_SCAN_WINDOW = 1 << 23
+
+def find_pam_sites(codes, pams):
+    """
+    Start positions of every occurrence of each literal PAM in pams (all of
+    one length), found in a single vectorized pass over an array of ASCII
+    codes. Returns one sorted array per PAM. Like str.find, matching is case
+    sensitive.
+    """
+    length = len(pams[0])
+    n = max(len(codes) - length + 1, 0)
+
+    matches = np.ones(n, dtype=bool)
+    for j in range(length):
+        column = np.zeros(n, dtype=bool)
+        for nuc in {pam[j] for pam in pams}:
+            column |= codes[j:j + n] == ord(nuc)
+        matches &= column
+    sites = np.flatnonzero(matches)
+
+    # tells the PAMs apart by their bases in the columns where they differ
+    varying = [j for j in range(length) if len({pam[j] for pam in pams}) > 1]
+    bases = {j: codes[sites + j] for j in varying}
+
+    pam_sites = []
+    for pam in pams:
+        keep = np.ones(len(sites), dtype=bool)
+        for j in varying:
+            keep &= bases[j] == ord(pam[j])
+        pam_sites.append(sites[keep])
+    return pam_sites
+
+def scan_pam_sites(seq, pam_sets, window=PAM_SCAN_WINDOW):
+    """
+    find_pam_sites over the whole of seq for each set of PAMs, reading seq
+    once in windows that overlap by the PAM length, so that memory depends
+    on the window size rather than on the chromosome length.
+    """
+    length = max(len(pams[0]) for pams in pam_sets)
+    found = [[[] for _ in pams] for pams in pam_sets]
+
+    for start in range(0, len(seq), window):
+        codes = sequence_codes(seq[start:start + window + length - 1])
+        for pams, pam_found in zip(pam_sets, found):
+            # the window's last length - 1 bases only complete sites starting in it
+            for sites, window_sites in zip(pam_found, find_pam_sites(codes, pams)):
+                sites.append((window_sites + start).astype(np.uint32))
+
+    return [
+        [np.concatenate(sites) if sites else np.empty(0, dtype=np.uint32) for sites in pam_found]
+        for pam_found in found
+    ]
 
-        if position < 0:
+class PamSiteIndex:
+    """
+    Every PAM site on one chromosome as sorted position arrays, one per
+    literal PAM: reverse strand sites first, then forward strand sites, each
+    in generate_pam_set order, and sites within a region in the order of
+    their position.
+    """
+
+    def __init__(self, seq, pam="NGG", k=20):
+        pams = generate_pam_set(pam)
+        reverse, forward = scan_pam_sites(seq, [[revcom(p) for p in pams], pams])
+        # forward guides lie k bases upstream of their PAM
+        forward = [sites[sites >= k] for sites in forward]
+
+        self.sites = reverse + forward
+        self.reverse_groups = len(reverse)
+
+    def lookup(self, starts, ends):
+        """
+        Candidate sites of every region: the sites with a PAM starting in
+        [start, end] are sites[g][lo[i, g]:hi[i, g]] for region i.
+        """
+        starts, ends = np.asarray(starts), np.asarray(ends)
+        lo = np.stack([np.searchsorted(sites, starts, side='left') for sites in self.sites], axis=-1)
+        hi = np.stack([np.searchsorted(sites, ends, side='right') for sites in self.sites], axis=-1)
+        return lo, np.maximum(lo, hi)
+
+    def candidates(self, lo, hi):
+        """
+        Concatenated candidate positions of one region, and how many of
+        them, coming first, are on the reverse strand.
+        """
+        positions = np.concatenate([sites[l:h] for sites, l, h in zip(self.sites, lo, hi)])
+        reverse = int((hi - lo)[:self.reverse_groups].sum())
+        return positions, reverse
+
+def make_guide(seq, site, forward, pam_length=3, k=20):
+    if forward:
+        kmer, position = seq[site - k:site], site - k
+    else:
+        kmer, position = seq[site + pam_length:site + pam_length + k], site
+    return str(kmer).upper(), position, '+' if forward else '-'
+
+def region_seed(region, seed):
+    """
+    Seed of one region's guide draw, derived from its feature ID, so that
+    the draw does not depend on which worker makes it or when. The
+    coordinates tell apart the parts of features sharing an ID, such as
+    the CDS segments of one protein.
+    """
+    key = f"{seed}:{region.id}:{region.seqid}:{region.start}:{region.end}"
+    return int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], "little")
+
+SAMPLER_STATE = {}
+
+def init_sampler(fasta_file, regions, pam, k, seed):
+    SAMPLER_STATE.update(genome=IndexedFasta(fasta_file), regions=regions, pam=pam, k=k, seed=seed)
+
+def sample_chromosome(task):
+    """
+    Draws a guide for every region of one chromosome, indexing its PAM
+    sites once. Returns (region index, guide) pairs; regions without
+    candidates are left out.
+    """
+    chrm, indices = task
+    genome, regions, pam, k, seed = (SAMPLER_STATE[key] for key in ("genome", "regions", "pam", "k", "seed"))
+
+    seq = genome[chrm].seq
+    index = PamSiteIndex(seq, pam, k)
+    lo, hi = index.lookup([regions[i].start for i in indices], [regions[i].end for i in indices])
+
+    guides = []
+    for i, l, h in zip(indices, lo, hi):
+        sites, reverse = index.candidates(l, h)
+        if len(sites) == 0:
             continue
 
-        yield (kmer.upper(), position)
-
-def get_random_guides(regions):
-    for region in regions:
-        chrm, start, end = region.seqid, region.start, region.end
-
-        if args.chr2acc:
-            if chrm not in acc2chrm:
-                continue
-
-        forward_guides = []
-        for pam in generate_pam_set("NGG"):
-            forward_guides += list(get_guides_across_region(record_dict[chrm].seq, start, end, pam))
+        j = random.Random(region_seed(regions[i], seed)).randrange(len(sites))
+        guides.append((i, make_guide(seq, int(sites[j]), j >= reverse, len(pam), k)))
+
+    return guides
+
+def get_random_guides(region_sets, fasta_file, acc2chrm=None, pam="NGG", k=20, seed=73, workers=1):
+    """
+    Draws a guide for the regions of every set, indexing each chromosome's
+    PAM sites once for all sets. Returns, per set, (guide, chromosome,
+    region) for every region with a candidate guide, in region order. With
+    acc2chrm, regions on other accessions are skipped and accessions are
+    renamed.
+    """
+    labels, regions = [], []
+    for label, region_set in enumerate(region_sets):
+        for region in region_set:
+            if acc2chrm is None or region.seqid in acc2chrm:
+                labels.append(label)
+                regions.append(region)
+
+    by_chrm = {}
+    for i, region in enumerate(regions):
+        by_chrm.setdefault(region.seqid, []).append(i)
+    # largest chromosomes first, so that they do not finish last
+    lengths = {name: entry.length for name, entry in load_fai(fasta_file).items()}
+    tasks = sorted(by_chrm.items(), key=lambda task: lengths[task[0]], reverse=True)
+
+    # workers open the genome themselves, so this works under any start method
+    init_args = (fasta_file, regions, pam, k, seed)
+    if workers > 1:
+        with multiprocessing.Pool(workers, init_sampler, init_args) as pool:
+            guides = dict(itertools.chain.from_iterable(pool.imap_unordered(sample_chromosome, tasks)))
+    else:
+        init_sampler(*init_args)
+        guides = dict(itertools.chain.from_iterable(map(sample_chromosome, tasks)))
+
+    set_guides = [[] for _ in region_sets]
+    for i, (label, region) in enumerate(zip(labels, regions)):
+        if i not in guides:
+            continue
 
-        reverse_guides = []
-        for pam in generate_pam_set("NGG"):
-            reverse_guides += list(get_guides_across_region(record_dict[chrm].seq, start, end, revcom(pam), forward=False))
+        chrm = region.seqid
+        if acc2chrm is not None:
+            chrm = acc2chrm[chrm]
 
-        forward_guides = [(x, y, '+') for (x, y) in forward_guides]
-        reverse_guides = [(x, y, '-') for (x, y) in reverse_guides]
+        set_guides[label].append((guides[i], chrm, region))
 
-        guides = reverse_guides + forward_guides
-        if not guides:
-            continue
+    return set_guides
 
-        if args.chr2acc:
-            chrm = acc2chrm[chrm]
+def region_guides_df(guides):
+    region_guides = []
+    for guide, chrm, region in guides:
+        region_guides.append({
+            "Identifier": f"{region.gene}:{chrm}:{guide[1]}",
+            "gRNA": str(guide[0]),
+            "Position": str(guide[1]),
+            "Chromosome": chrm,
+            "Gene": region.gene,
+            "PAM": "NGG",
+            "Strand": guide[2]
+        })
 
-        guide = random.sample(guides, 1)[0]
-        yield guide, chrm, region
+    return pd.DataFrame(region_guides)
 
 def parse_arguments():
     parser = argparse.ArgumentParser(
@@ -90,11 +237,12 @@ def parse_arguments():
     )
 
     parser.add_argument(
-        "reference_genome", help="FASTA reference genome."
+        "reference_genome", help="FASTA reference genome (uncompressed, indexed on first use)."
     )
 
     parser.add_argument(
-        "annotation_db", help="Genomic annotations in GFF format."
+        "annotation_db",
+        help="Genomic annotations: a GFF3 file or gffutils database, compiled to a columnar store on first use, or the store."
     )
 
     parser.add_argument(
@@ -109,11 +257,22 @@ def parse_arguments():
         "-o", help="Output prefix"
     )
 
+    parser.add_argument(
+        "--seed", type=int, default=73,
+        help="Seed of the region samples; each region's guide is drawn from a seed derived from it and its feature ID."
+    )
+
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="Processes sampling guides, one chromosome at a time. Results do not depend on it."
+    )
+
     return parser.parse_args()
 
 if __name__ == "__main__":
     args = parse_arguments()
 
+    acc2chrm = None
     if args.chr2acc:
         acc2chrm = {}
         with open(args.chr2acc, "r") as f:
@@ -122,64 +281,17 @@ if __name__ == "__main__":
                 chrm, acc = line.split()
                 acc2chrm[acc] = chrm
 
-    random.seed(73)
-    record_dict = SeqIO.to_dict(SeqIO.parse(args.reference_genome, "fasta"))
-    db = gffutils.FeatureDB(args.annotation_db)
+    store = AnnotationStore.open(args.annotation_db)
+    rng = np.random.default_rng(args.seed)
 
-    lnc_regions = list(db.features_of_type("lnc_RNA"))
-    random_lnc_regions = random.sample(lnc_regions, 10_000)
+    random_lnc_regions = store.regions(store.sample("lnc_RNA", 10_000, rng))
+    random_mirna_regions = store.regions(store.sample("miRNA", 1_000, rng))
+    random_cds_regions = store.regions(store.sample("CDS", 10_000, rng))
 
-    random_lnc_guides = []
-    for guide, chrm, lnc_region in get_random_guides(random_lnc_regions):
-        random_lnc_guides.append({
-            "Identifier": f"{lnc_region.attributes['gene'][0]}:{chrm}:{guide[1]}",
-            "gRNA": str(guide[0]),
-            "Position": str(guide[1]),
-            "Chromosome": chrm,
-            "Gene": lnc_region.attributes["gene"][0],
-            "PAM": "NGG",
-            "Strand": guide[2]
-        })
-
-    random_lnc_df = pd.DataFrame(random_lnc_guides)
-
-    mirna_regions = list(db.features_of_type("miRNA"))
-    random_mirna_regions = random.sample(mirna_regions, 1_000)
-
-    random_mirna_guides = []
-    for guide, chrm, mirna_region in get_random_guides(random_mirna_regions):
-        random_mirna_guides.append({
-            "Identifier": f"{mirna_region.attributes['gene'][0]}:{chrm}:{guide[1]}",
-            "gRNA": str(guide[0]),
-            "Position": str(guide[1]),
-            "Chromosome": chrm,
-            "Gene": mirna_region.attributes["gene"][0],
-            "PAM": "NGG",
-            "Strand": guide[2]
-        })
-
-    random_mirna_df = pd.DataFrame(random_mirna_guides)
-
-    cds_regions = list(db.features_of_type("CDS"))
-    random_cds_regions = random.sample(cds_regions, 10_000)
-
-    random_cds_guides = []
-    for guide, chrm, cds_region in get_random_guides(random_cds_regions):
-        random_cds_guides.append({
-            "Identifier": f"{cds_region.attributes['gene'][0]}:{chrm}:{guide[1]}",
-            "gRNA": str(guide[0]),
-            "Position": str(guide[1]),
-            "Chromosome": chrm,
-            "Gene": cds_region.attributes["gene"][0],
-            "PAM": "NGG",
-            "Strand": guide[2]
-        })
-
-    random_cds_df = pd.DataFrame(random_cds_guides)
-
-    unif_random_guides = [
-        {"Identifier": f"{g}_{i}", "gRNA": g, "PAM": "NGG"} for (i, g) in enumerate(uniformly_random_guides(10_000))
-    ]
+    random_lnc_df, random_mirna_df, random_cds_df = map(region_guides_df, get_random_guides(
+        [random_lnc_regions, random_mirna_regions, random_cds_regions],
+        args.reference_genome, acc2chrm, seed=args.seed, workers=args.workers
+    ))
 
     analyzed_library_df = pd.read_csv(args.analyzed_library)
     analyzed_library_df = analyzed_library_df[analyzed_library_df['chr'].isin(acc2chrm)]
@@ -207,8 +319,7 @@ if __name__ == "__main__":
             .sample(10000)\
             .to_csv(f"{args.o}_published_n{n}_guides.csv")
 
-    unif_random_guides_df = pd.DataFrame(unif_random_guides)
     random_mirna_df.to_csv(f"{args.o}_mirna_guides.csv")
     random_lnc_df.to_csv(f"{args.o}_lnc_guides.csv")
     random_cds_df.to_csv(f"{args.o}_cds_guides.csv")
-    unif_random_guides_df.to_csv(f"{args.o}_unif_guides.csv")
+    write_random_guides(f"{args.o}_unif_guides.csv", random_guide_chunks(10_000, rng=rng))
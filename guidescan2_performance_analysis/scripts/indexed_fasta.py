@@ -0,0 +1,180 @@
+"""
+Lazy, faidx-style access to a FASTA reference. The `.fai` offset index
+(the samtools layout) is built once next to the FASTA, the file is
+memory-mapped, and sequence is read in fixed size blocks kept in an LRU
+cache, so only the parts of the genome that are touched are ever loaded.
+
+    record_dict = IndexedFasta("genome.fna")
+    record_dict["NC_000001.11"].seq[1000:1020]
+"""
+
+import collections
+import collections.abc
+import functools
+import mmap
+import os
+
+BLOCK_SIZE = 1 << 20
+
+FaiEntry = collections.namedtuple("FaiEntry", ["length", "offset", "line_bases", "line_width"])
+
+def build_fai(fasta_file):
+    """
+    Offset index of fasta_file, as samtools faidx writes it. Every line of a
+    sequence but its last must have the same length.
+    """
+    index = {}
+    name = None
+
+    def finish():
+        if name is not None:
+            index[name] = FaiEntry(length, offset, line_bases, line_width)
+
+    with open(fasta_file, "rb") as f:
+        position = 0
+        for line in f:
+            if line.startswith(b">"):
+                finish()
+                name = line[1:].split()[0].decode()
+                length, offset, line_bases, line_width = 0, position + len(line), 0, 0
+                last_line = False
+            elif name is not None:
+                bases = len(line.rstrip(b"\r\n"))
+                if bases > 0:
+                    if line_bases == 0:
+                        line_bases, line_width = bases, len(line)
+                    elif last_line or bases > line_bases:
+                        raise ValueError(f"{fasta_file}: different line length in sequence {name}")
+                    last_line = bases < line_bases
+                    length += bases
+            position += len(line)
+        finish()
+
+    return index
+
+def write_fai(index, fai_file):
+    with open(fai_file, "w") as f:
+        for name, entry in index.items():
+            f.write("\t".join(map(str, (name, *entry))) + "\n")
+
+def read_fai(fai_file):
+    index = {}
+    with open(fai_file) as f:
+        for line in f:
+            name, *fields = line.split("\t")[:5]
+            index[name] = FaiEntry(*map(int, fields))
+    return index
+
+def load_fai(fasta_file):
+    """
+    Reads fasta_file.fai, building it first if missing or out of date.
+    """
+    fai_file = fasta_file + ".fai"
+    if os.path.exists(fai_file) and os.path.getmtime(fai_file) >= os.path.getmtime(fasta_file):
+        return read_fai(fai_file)
+
+    index = build_fai(fasta_file)
+    try:
+        write_fai(index, fai_file)
+    except OSError:
+        pass
+    return index
+
+class FastaSequence:
+    """
+    One sequence of an IndexedFasta. Slicing returns a str and, like
+    bytes(Seq), bytes() returns the whole sequence.
+    """
+
+    def __init__(self, fasta, name, entry):
+        self.fasta = fasta
+        self.name = name
+        self.entry = entry
+
+    def __len__(self):
+        return self.entry.length
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            position = key + len(self) if key < 0 else key
+            if not 0 <= position < len(self):
+                raise IndexError("sequence index out of range")
+            return self[position:position + 1]
+
+        start, stop, step = key.indices(len(self))
+        if step != 1:
+            return "".join(self[i] for i in range(start, stop, step))
+        if start >= stop:
+            return ""
+
+        first, last = start // self.fasta.block_size, (stop - 1) // self.fasta.block_size
+        blocks = b"".join(self.fasta.block(self.name, b) for b in range(first, last + 1))
+        offset = first * self.fasta.block_size
+        return blocks[start - offset:stop - offset].decode()
+
+    def __bytes__(self):
+        return self.fasta.read(self.entry, 0, len(self))
+
+    def __str__(self):
+        return bytes(self).decode()
+
+class FastaRecord:
+    def __init__(self, seq):
+        self.id = seq.name
+        self.seq = seq
+
+    def __len__(self):
+        return len(self.seq)
+
+class IndexedFasta(collections.abc.Mapping):
+    """
+    Read-only mapping from sequence name to record, a drop-in for
+    SeqIO.to_dict on uncompressed FASTA files. Keeps at most cache_blocks
+    blocks of block_size bases in memory.
+    """
+
+    def __init__(self, fasta_file, block_size=BLOCK_SIZE, cache_blocks=64):
+        self.index = load_fai(fasta_file)
+        self.block_size = block_size
+
+        with open(fasta_file, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(fasta_file) else b""
+
+        self.block = functools.lru_cache(maxsize=cache_blocks)(self.read_block)
+
+    def file_offset(self, entry, position):
+        lines, column = divmod(position, entry.line_bases)
+        return entry.offset + lines * entry.line_width + column
+
+    def read(self, entry, start, stop):
+        """
+        Bases [start, stop) of a sequence, line breaks removed.
+        """
+        if start >= stop:
+            return b""
+        raw = self.data[self.file_offset(entry, start):self.file_offset(entry, stop - 1) + 1]
+        return raw.translate(None, b"\r\n")
+
+    def read_block(self, name, block):
+        entry = self.index[name]
+        start = block * self.block_size
+        return self.read(entry, start, min(start + self.block_size, entry.length))
+
+    def __getitem__(self, name):
+        return FastaRecord(FastaSequence(self, name, self.index[name]))
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
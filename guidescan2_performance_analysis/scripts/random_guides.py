@@ -0,0 +1,169 @@
+"""
+Generates random gRNAs in bulk for uniform benchmark sets. Guides are drawn
+as whole (n, k) base matrices with NumPy and written in chunks, so sets of
+many millions of guides stream to disk in constant memory (except for the
+set of guides already drawn that --unique keeps).
+"""
+
+import argparse
+
+import numpy as np
+import pandas as pd
+
+# A and T share the AT fraction, C and G the GC fraction
+BASES = np.frombuffer(b"ATCG", dtype=np.uint8)
+
+def base_probabilities(gc_content):
+    return np.array([1 - gc_content, 1 - gc_content, gc_content, gc_content]) / 2
+
+def has_homopolymer(guides, length):
+    """
+    Rows of a base matrix containing a run of length or more identical bases.
+    """
+    same = guides[:, 1:] == guides[:, :-1]
+    if same.shape[1] < length - 1:
+        return np.zeros(len(guides), dtype=bool)
+    windows = np.lib.stride_tricks.sliding_window_view(same, length - 1, axis=1)
+    return windows.all(axis=2).any(axis=1)
+
+def as_strings(guides):
+    """
+    Base matrix as an array of fixed width byte strings, which sort and
+    compare as whole guides.
+    """
+    return np.ascontiguousarray(guides).view(f"S{guides.shape[1]}").ravel()
+
+def random_guide_chunks(n, k=20, gc_content=0.5, max_homopolymer=None,
+                        unique=False, exclude=None, chunk_size=1_000_000, rng=None):
+    """
+    Yields n random guides of length k as chunks of at most chunk_size byte
+    strings. Bases are drawn independently, C and G each with probability
+    gc_content / 2. Guides with a run of max_homopolymer identical bases,
+    or found in exclude, are redrawn; with unique, so are repeats.
+    """
+    if max_homopolymer is not None and max_homopolymer < 2:
+        raise ValueError("every guide has a homopolymer of length 1")
+    if unique and n + len(exclude or []) > 4 ** k:
+        raise ValueError(f"too few distinct guides of length {k}")
+
+    rng = np.random.default_rng() if rng is None else rng
+    cumulative = np.cumsum(base_probabilities(gc_content))
+
+    seen = np.empty(0, dtype=f"S{k}")
+    if exclude is not None:
+        seen = np.unique(np.asarray([g for g in exclude if len(g) == k], dtype=f"S{k}"))
+
+    remaining = n
+    while remaining > 0:
+        size = min(chunk_size, remaining)
+        chunk = np.empty(0, dtype=f"S{k}")
+        while len(chunk) < size:
+            # draws a little extra, to make up for rejected guides
+            draws = size - len(chunk)
+            codes = np.searchsorted(cumulative, rng.random((draws + draws // 8 + 16, k)), side="right")
+            guides = BASES[np.minimum(codes, 3)]
+
+            if max_homopolymer is not None:
+                guides = guides[~has_homopolymer(guides, max_homopolymer)]
+            strings = np.concatenate([chunk, as_strings(guides)])
+
+            if unique:
+                # first occurrence of every guide, in draw order
+                strings = strings[np.sort(np.unique(strings, return_index=True)[1])]
+            if len(seen) > 0:
+                position = np.minimum(np.searchsorted(seen, strings), len(seen) - 1)
+                strings = strings[seen[position] != strings]
+            chunk = strings[:size]
+
+        if unique:
+            seen = np.union1d(seen, chunk)
+        remaining -= size
+        yield chunk
+
+def write_random_guides(output, chunks, pam="NGG"):
+    """
+    Writes guides as a CSV of Identifier, gRNA and PAM, in the layout of
+    the uniform guide sets of guide_selection.py.
+    """
+    offset = 0
+    for i, chunk in enumerate(chunks):
+        guides = chunk.astype(str)
+        index = np.arange(offset, offset + len(chunk))
+        pd.DataFrame({
+            "Identifier": np.char.add(np.char.add(guides, "_"), index.astype(str)),
+            "gRNA": guides,
+            "PAM": pam,
+        }, index=index).to_csv(output, mode="w" if i == 0 else "a", header=i == 0)
+        offset += len(chunk)
+
+def read_guides(guides_file):
+    """
+    Guides of a text file with one per line, or of the gRNA column of a CSV.
+    """
+    with open(guides_file) as f:
+        header = f.readline()
+    if "," in header:
+        return pd.read_csv(guides_file, usecols=["gRNA"])["gRNA"].str.upper().tolist()
+    with open(guides_file) as f:
+        return [line.strip().upper() for line in f if line.strip()]
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Generates uniformly random gRNAs for benchmark sets."
+    )
+
+    parser.add_argument(
+        "n", type=int, help="Number of guides."
+    )
+
+    parser.add_argument(
+        "-o", required=True, help="Output CSV."
+    )
+
+    parser.add_argument(
+        "-k", type=int, default=20, help="Guide length."
+    )
+
+    parser.add_argument(
+        "--gc-content", type=float, default=0.5,
+        help="Expected G/C fraction of the guides."
+    )
+
+    parser.add_argument(
+        "--max-homopolymer", type=int,
+        help="Reject guides with a run of this many identical bases."
+    )
+
+    parser.add_argument(
+        "--unique", action="store_true",
+        help="Reject repeated guides. Keeps every guide drawn in memory."
+    )
+
+    parser.add_argument(
+        "--exclude",
+        help="Reject the guides of this file, one per line or a CSV with a gRNA column."
+    )
+
+    parser.add_argument(
+        "--pam", default="NGG"
+    )
+
+    parser.add_argument(
+        "--chunk-size", type=int, default=1_000_000
+    )
+
+    parser.add_argument(
+        "--seed", type=int, default=0
+    )
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    exclude = read_guides(args.exclude) if args.exclude else None
+    chunks = random_guide_chunks(
+        args.n, args.k, args.gc_content, args.max_homopolymer, args.unique, exclude,
+        args.chunk_size, np.random.default_rng(args.seed)
+    )
+    write_random_guides(args.o, chunks, args.pam)
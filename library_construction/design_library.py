@@ -1,13 +1,26 @@
 import argparse
+import itertools
+import multiprocessing
 import numpy as np
+import os
 import pandas as pd
 import sys
 
-from funcy import ilen
+from collections import Counter
+from selection import group_nlargest
 
 TIERS = [(1, 0.7), (0.7, 0.45), (0.45, 0.30), (0.30, 0.15), (0.15, 0)]
 VERBOSE = False
 
+DEFAULT_PARAMETERS = {
+    'cutting_efficiency': 0.25,
+    'specificity': 0.20,
+    'gc_bounds': (0.20, 0.80),
+    'monopolymer': 4,
+    'guides_per_gene': 6,
+    'tiers': TIERS,
+}
+
 def log(*args, **kwargs):
     if VERBOSE:
         print(*args, file=sys.stderr, **kwargs)
@@ -19,62 +32,77 @@ def rank(xs, x):
             return len(xs) - i
     return 0
 
-def contains_monopolymer(seq, k=4):
-    count, last = 1, seq[0]
-    for i in range(1, len(seq)):
-        if count >= k:
-            return True
-
-        if seq[i] == last:
-            count += 1
-            continue
-        
-        count = 0
-        last = seq[i]
-        
-    if count >= k:
-        return True 
-    
-    return False
-
-def rank_guides(guide):
-    gc_cont = guide['G/C Content']
-    
-    if guide['type'] == 'exon':
-        return -1
-    
-    if gc_cont < 0.20 or gc_cont > 0.80:
-        return -2
-    
-    sgrna = guide['sgRNA']
-    if contains_monopolymer(sgrna, 4):
-        return -3
-    
-    return min(guide['min_specificity'], 1.25 * guide['cutting_efficiency'])
-
-def min_revision(guidescan_df):
-    ranker = lambda g: rank_guides(g)
-
-    guidescan_df = guidescan_df.copy()
-    guidescan_df['rank'] = guidescan_df.apply(ranker, axis=1)
-
-    log(
-        f'Number of G/C content filtered sgRNAs: '
-        f'{len(guidescan_df[~guidescan_df["rank"].isin([-1, -2])])}'
+def gc_content(sgrnas):
+    return (sgrnas.str.count('G') + sgrnas.str.count('C')) / sgrnas.str.len()
+
+def contains_monopolymer(sgrnas, k=4):
+    """
+    Flags the sgRNAs containing a monopolymer. The leading run of a
+    sequence counts from its first base, so it needs k repeats; the counter
+    resets to zero on every later base change, so later runs need k + 1.
+    """
+    seqs = np.array(sgrnas.tolist(), dtype=bytes)
+    codes = seqs.view(np.uint8).reshape(len(seqs), seqs.dtype.itemsize)
+
+    # same[:, i] is set when base i + 1 repeats base i; padding never repeats
+    same = (codes[:, 1:] == codes[:, :-1]) & (codes[:, 1:] != 0)
+
+    monopolymer = np.zeros(len(seqs), dtype=bool)
+    if same.shape[1] >= k - 1:
+        monopolymer |= same[:, :k - 1].all(axis=1)
+    if same.shape[1] >= k:
+        monopolymer |= np.lib.stride_tricks.sliding_window_view(same, k, axis=1).all(axis=2).any(axis=1)
+
+    return pd.Series(monopolymer, index=sgrnas.index)
+
+def rank_guides(guidescan_df, gc_bounds=(0.20, 0.80), monopolymer=4):
+    """
+    Ranks guides by min(min_specificity, 1.25 * cutting_efficiency),
+    marking exon cutting guides -1, guides outside the G/C content bounds
+    (20-80%) -2 and guides with monopolymers -3.
+    """
+    gc_min, gc_max = gc_bounds
+    gc_cont = guidescan_df['G/C Content']
+    min_specificity = guidescan_df['min_specificity'].to_numpy()
+    cutting_efficiency = 1.25 * guidescan_df['cutting_efficiency'].to_numpy()
+
+    rank = np.select(
+        [
+            (guidescan_df['type'] == 'exon').to_numpy(),
+            ((gc_cont < gc_min) | (gc_cont > gc_max)).to_numpy(),
+            contains_monopolymer(guidescan_df['sgRNA'], monopolymer).to_numpy(),
+        ],
+        [-1, -2, -3],
+        # keeps min()'s first argument on ties and NaNs
+        np.where(cutting_efficiency < min_specificity, cutting_efficiency, min_specificity)
     )
 
+    return pd.Series(rank, index=guidescan_df.index)
 
-    log(
-        f'Number of monopolymer filtered sgRNAs: '
-        f'{len(guidescan_df[~guidescan_df["rank"].isin([-1, -2, -3])])}'
-    )
+def min_revision(guidescan_df, guides_per_gene=6):
+    g = group_nlargest(guidescan_df, 'gene', 'rank', guides_per_gene)
 
-    g = guidescan_df.groupby('gene').apply(lambda df: df.nlargest(6, ['rank']))
-    
     return g.reset_index(drop=True)
 
-def build_safe_targeting_controls(args):
-    safe_targeting_controls = pd.read_csv(args.safe_targeting_csv)
+def read_csv_chunks(csv_file, chunksize=None, **kwargs):
+    """
+    Reads csv_file whole, or in chunks of chunksize rows. Unnamed index
+    columns, which never reach the library, are skipped.
+    """
+    usecols = lambda column: not column.startswith('Unnamed')
+    if chunksize is None:
+        yield pd.read_csv(csv_file, usecols=usecols, **kwargs)
+    else:
+        yield from pd.read_csv(csv_file, usecols=usecols, chunksize=chunksize, **kwargs)
+
+SAFE_TARGETING_DTYPES = {
+    'chr': 'category',
+    'antisense': bool,
+    'specificity': np.float64,
+    'cutting_efficiency': np.float64,
+}
+
+def prepare_safe_targeting_controls(safe_targeting_controls):
     safe_targeting_controls.loc[safe_targeting_controls['antisense'], 'Strand'] = '-'
     safe_targeting_controls.loc[~safe_targeting_controls['antisense'], 'Strand'] = '-'
     safe_targeting_controls['sgRNA'] = safe_targeting_controls['sgRNA'].str[:-3]
@@ -93,8 +121,27 @@ def build_safe_targeting_controls(args):
     )
 
     safe_targeting_controls['Type'] = 'safe_targeting_control'
-    safe_targeting_controls = safe_targeting_controls.sort_values(by='Specificity', ascending=False)
-    safe_targeting_controls = safe_targeting_controls.iloc[:5000]
+    return safe_targeting_controls
+
+def top_safe_targeting_controls(safe_targeting_controls, k=5000):
+    # stable, so that ties keep file order whether or not the input is chunked
+    safe_targeting_controls = safe_targeting_controls.sort_values(
+        by='Specificity', ascending=False, kind='stable'
+    )
+    return safe_targeting_controls.iloc[:k]
+
+def build_safe_targeting_controls(args):
+    """
+    Keeps the 5000 most specific safe-targeting controls. In chunked mode
+    only the best 5000 seen so far are held in memory.
+    """
+    safe_targeting_controls = None
+    chunks = read_csv_chunks(args.safe_targeting_csv, args.chunksize, dtype=SAFE_TARGETING_DTYPES)
+    for chunk in chunks:
+        chunk = prepare_safe_targeting_controls(chunk)
+        if safe_targeting_controls is not None:
+            chunk = pd.concat([safe_targeting_controls, chunk])
+        safe_targeting_controls = top_safe_targeting_controls(chunk)
 
     return safe_targeting_controls
 
@@ -110,11 +157,23 @@ def build_non_targeting_controls(args):
 
     return non_targeting_controls
 
-def build_gene_targeting_guides(args):
-    guidescan_df = pd.read_csv(args.guidescan_csv)
-
-    log(f'Number of exon filtered sgRNAs: {len(guidescan_df[guidescan_df["type"] == "exon"])}')
-    log(f'Number of CDS filtered sgRNAs: {len(guidescan_df[guidescan_df["type"] == "CDS"])}')
+GUIDESCAN_DTYPES = {
+    'type': 'category',
+    'strand': 'category',
+    'chr': 'category',
+    'specificity': np.float64,
+    '5pG Specificity': np.float64,
+    'cutting_efficiency': np.float64,
+}
+
+def annotate_guides(guidescan_df, counts):
+    """
+    The parameter-independent preparation of the guide table: trims IDs
+    and PAMs, drops guides without a 5pG specificity and adds the minimum
+    specificity and G/C content.
+    """
+    counts['exon'] += (guidescan_df['type'] == 'exon').sum()
+    counts['CDS'] += (guidescan_df['type'] == 'CDS').sum()
 
     guidescan_df['gene'] = guidescan_df['gene'].str[5:]
     guidescan_df['identifier'] = guidescan_df['identifier'].str[5:]
@@ -122,27 +181,60 @@ def build_gene_targeting_guides(args):
     guidescan_df['PAM'] = 'NGG'
     guidescan_df = guidescan_df[~guidescan_df['5pG Specificity'].isna()]
     guidescan_df['min_specificity'] = guidescan_df[['specificity', '5pG Specificity']].min(axis=1)
+    guidescan_df['G/C Content'] = gc_content(guidescan_df['sgRNA'])
 
-    guidescan_df = guidescan_df[guidescan_df['cutting_efficiency'] > 0.25]
+    return guidescan_df
 
-    log(
-        f'Number of cutting efficiency (> 0.25) filtered sgRNAs: '
-        f'{len(guidescan_df[guidescan_df["type"] == "CDS"])}'
-    )
+def filter_gene_targeting_guides(guidescan_df, counts, parameters):
+    """
+    Applies the per-guide cutoffs and ranks the remaining guides, adding
+    the number of guides left after each step to counts.
+    """
+    guidescan_df = guidescan_df[guidescan_df['cutting_efficiency'] > parameters['cutting_efficiency']]
+    counts['cutting_efficiency'] += (guidescan_df['type'] == 'CDS').sum()
 
-    guidescan_df = guidescan_df[guidescan_df['specificity'] > 0.20]
+    guidescan_df = guidescan_df[guidescan_df['specificity'] > parameters['specificity']]
+    counts['specificity'] += (guidescan_df['type'] == 'CDS').sum()
 
-    log(
-        f'Number of specificity (> 0.20) filtered sgRNAs: '
-        f'{len(guidescan_df[guidescan_df["type"] == "CDS"])}'
-    )
+    guidescan_df['rank'] = rank_guides(guidescan_df, parameters['gc_bounds'], parameters['monopolymer'])
 
-    guidescan_df['G/C Content'] = guidescan_df['sgRNA'].apply(
-        lambda sgrna: ilen(filter(lambda n: n in ['G', 'C'], sgrna)) / len(sgrna)
-    )
+    counts['gc_content'] += (~guidescan_df['rank'].isin([-1, -2])).sum()
+    counts['monopolymer'] += (~guidescan_df['rank'].isin([-1, -2, -3])).sum()
 
-    gene_targeting = min_revision(guidescan_df)
+    return guidescan_df
 
+def log_filter_counts(counts, parameters):
+    log(f'Number of exon filtered sgRNAs: {counts["exon"]}')
+    log(f'Number of CDS filtered sgRNAs: {counts["CDS"]}')
+    log(
+        f'Number of cutting efficiency (> {parameters["cutting_efficiency"]:.2f}) filtered sgRNAs: '
+        f'{counts["cutting_efficiency"]}'
+    )
+    log(
+        f'Number of specificity (> {parameters["specificity"]:.2f}) filtered sgRNAs: '
+        f'{counts["specificity"]}'
+    )
+    log(f'Number of G/C content filtered sgRNAs: {counts["gc_content"]}')
+    log(f'Number of monopolymer filtered sgRNAs: {counts["monopolymer"]}')
+
+def build_gene_targeting_guides(args, parameters=DEFAULT_PARAMETERS):
+    """
+    Selects the best ranked guides per gene. In chunked mode only the best
+    guides per gene seen so far are held in memory; earlier guides stay
+    ahead of later ones on ties, so the selection is the same.
+    """
+    counts = Counter()
+    guidescan_df = None
+    for chunk in read_csv_chunks(args.guidescan_csv, args.chunksize, dtype=GUIDESCAN_DTYPES):
+        chunk = filter_gene_targeting_guides(annotate_guides(chunk, counts), counts, parameters)
+        if guidescan_df is not None:
+            chunk = pd.concat([guidescan_df, chunk])
+        guidescan_df = min_revision(chunk, parameters['guides_per_gene'])
+
+    log_filter_counts(counts, parameters)
+    return finish_gene_targeting_guides(guidescan_df)
+
+def finish_gene_targeting_guides(gene_targeting):
     gene_targeting.rename(columns={
         'gene': 'Gene',
         'identifier': 'Identifier',
@@ -191,23 +283,73 @@ def parse_arguments():
         help='Name of output CSV.'
     )
 
+    parser.add_argument(
+        '--chunksize', type=int,
+        help=('Stream the guide CSVs in chunks of this many rows, keeping only '
+              'the best guides seen so far in memory.')
+    )
+
     parser.add_argument(
         '-v', '--verbose', action='store_true',
         help='Verbose mode.'
     )
-    
-    return parser.parse_args()
 
-def main():
-    args = parse_arguments()
+    parser.add_argument(
+        '--sweep', metavar='OUTDIR',
+        help=('Design one library per combination of the parameter values below, '
+              'writing them and a summary table to OUTDIR.')
+    )
 
-    global VERBOSE
-    VERBOSE = args.verbose
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='Number of processes designing sweep configurations.'
+    )
 
-    non_targeting_controls = build_non_targeting_controls(args)
-    safe_targeting_controls = build_safe_targeting_controls(args)
-    gene_targeting_guides = build_gene_targeting_guides(args)
+    parser.add_argument(
+        '--cutting-efficiency', type=float, nargs='+',
+        default=[DEFAULT_PARAMETERS['cutting_efficiency']],
+        help='Cutting efficiency cutoff(s).'
+    )
 
+    parser.add_argument(
+        '--specificity', type=float, nargs='+',
+        default=[DEFAULT_PARAMETERS['specificity']],
+        help='Specificity cutoff(s).'
+    )
+
+    parser.add_argument(
+        '--gc-bounds', type=parse_bounds, nargs='+', metavar='MIN:MAX',
+        default=[DEFAULT_PARAMETERS['gc_bounds']],
+        help='G/C content bounds, e.g. 0.20:0.80.'
+    )
+
+    parser.add_argument(
+        '--monopolymer', type=int, nargs='+',
+        default=[DEFAULT_PARAMETERS['monopolymer']],
+        help='Monopolymer length(s) rejected.'
+    )
+
+    parser.add_argument(
+        '--guides-per-gene', type=int, nargs='+',
+        default=[DEFAULT_PARAMETERS['guides_per_gene']],
+        help='Guides selected per gene.'
+    )
+
+    parser.add_argument(
+        '--tiers', type=parse_tiers, nargs='+',
+        default=[DEFAULT_PARAMETERS['tiers']],
+        help=('Descending guide rank tier boundaries, e.g. '
+              f'{format_tiers(TIERS)}, reported in the sweep summary.')
+    )
+
+    args = parser.parse_args()
+
+    if not args.sweep and any(len(getattr(args, name)) > 1 for name in DEFAULT_PARAMETERS):
+        parser.error('multiple parameter values require --sweep')
+
+    return args
+
+def assemble_library(gene_targeting_guides, non_targeting_controls, safe_targeting_controls):
     full_library = pd.concat([
         gene_targeting_guides,
         non_targeting_controls,
@@ -217,8 +359,155 @@ def main():
     unnamed_columns = list(filter(lambda s: s.startswith('Unnamed'), full_library.columns))
     full_library.drop(columns=unnamed_columns, inplace=True)
     full_library.drop(columns=['rank'], inplace=True)
-    full_library['G/C Content'] = full_library['sgRNA'].apply(
-        lambda sgrna: ilen(filter(lambda n: n in ['G', 'C'], sgrna)) / len(sgrna)
+    full_library['G/C Content'] = gc_content(full_library['sgRNA'])
+
+    return full_library
+
+###########################
+## Parameter sweep mode ##
+###########################
+
+SWEEP_STATE = {}
+
+def parameter_grid(args):
+    names = list(DEFAULT_PARAMETERS)
+    values = [getattr(args, name) for name in names]
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+def load_sweep_guides(args, grid):
+    """
+    Loads and annotates the guide table once for every configuration,
+    keeping only the guides that pass the loosest cutoffs in the grid.
+    """
+    cutting_efficiency = min(parameters['cutting_efficiency'] for parameters in grid)
+    specificity = min(parameters['specificity'] for parameters in grid)
+
+    counts = Counter()
+    chunks = []
+    for chunk in read_csv_chunks(args.guidescan_csv, args.chunksize, dtype=GUIDESCAN_DTYPES):
+        chunk = annotate_guides(chunk, counts)
+        chunk = chunk[(chunk['cutting_efficiency'] > cutting_efficiency) & (chunk['specificity'] > specificity)]
+        chunks.append(chunk)
+
+    return pd.concat(chunks)
+
+def tier_guides(scores, tiers):
+    """
+    Vectorized rank(tiers, score): the tier of each score, 0 if it lies in
+    none of them.
+    """
+    tier = np.zeros(len(scores), dtype=np.int64)
+    # the first matching tier wins, so later tiers are assigned first
+    for i, (h, l) in reversed(list(enumerate(tiers))):
+        tier[(scores <= h) & (scores > l)] = len(tiers) - i
+    return tier
+
+def summarize_library(gene_targeting, parameters):
+    guides_per_gene = gene_targeting.groupby('gene').size()
+    tiers = tier_guides(gene_targeting['rank'].to_numpy(), parameters['tiers'])
+
+    summary = {
+        'Cutting Efficiency Cutoff': parameters['cutting_efficiency'],
+        'Specificity Cutoff': parameters['specificity'],
+        'Min G/C Content': parameters['gc_bounds'][0],
+        'Max G/C Content': parameters['gc_bounds'][1],
+        'Monopolymer Length': parameters['monopolymer'],
+        'Guides Per Gene': parameters['guides_per_gene'],
+        'Tiers': format_tiers(parameters['tiers']),
+        'Gene Targeting Guides': len(gene_targeting),
+        'Genes': len(guides_per_gene),
+        'Complete Genes': (guides_per_gene == parameters['guides_per_gene']).sum(),
+        'Filtered Guides': (gene_targeting['rank'] < 0).sum(),
+    }
+    for tier in range(len(parameters['tiers']), -1, -1):
+        summary[f'Tier {tier} Guides'] = (tiers == tier).sum()
+    return summary
+
+def init_sweep_worker(guides, non_targeting_controls, safe_targeting_controls, outdir):
+    SWEEP_STATE.update(
+        guides=guides,
+        non_targeting_controls=non_targeting_controls,
+        safe_targeting_controls=safe_targeting_controls,
+        outdir=outdir,
+    )
+
+def design_configuration(task):
+    i, parameters = task
+    counts = Counter()
+    gene_targeting = filter_gene_targeting_guides(SWEEP_STATE['guides'], counts, parameters)
+    gene_targeting = min_revision(gene_targeting, parameters['guides_per_gene'])
+    summary = summarize_library(gene_targeting, parameters)
+
+    full_library = assemble_library(
+        finish_gene_targeting_guides(gene_targeting),
+        SWEEP_STATE['non_targeting_controls'],
+        SWEEP_STATE['safe_targeting_controls'],
+    )
+
+    library_csv = f'library_{i:03d}.csv'
+    full_library.to_csv(os.path.join(SWEEP_STATE['outdir'], library_csv))
+    return {'Library': library_csv, **summary}
+
+def sweep(args, non_targeting_controls, safe_targeting_controls):
+    """
+    Designs one library per parameter configuration in the grid, sharing a
+    single annotated guide table between them, and writes them with a
+    summary table to args.sweep.
+    """
+    grid = parameter_grid(args)
+    os.makedirs(args.sweep, exist_ok=True)
+
+    init_args = (load_sweep_guides(args, grid), non_targeting_controls, safe_targeting_controls, args.sweep)
+
+    tasks = list(enumerate(grid))
+    if args.workers > 1:
+        with multiprocessing.Pool(args.workers, init_sweep_worker, init_args) as pool:
+            summaries = pool.map(design_configuration, tasks, chunksize=1)
+    else:
+        init_sweep_worker(*init_args)
+        summaries = list(map(design_configuration, tasks))
+
+    # configurations with fewer tiers have no guides in the missing ones
+    summary = pd.DataFrame(summaries)
+    tier_columns = [column for column in summary.columns if column.startswith('Tier ')]
+    summary[tier_columns] = summary[tier_columns].fillna(0).astype(int)
+    summary.to_csv(os.path.join(args.sweep, 'summary.csv'), index=False)
+
+def parse_bounds(bounds):
+    low, high = bounds.split(':')
+    return float(low), float(high)
+
+def parse_tiers(tiers):
+    """
+    Parses descending tier boundaries, e.g. 1,0.7,0.45,0.30,0.15,0, into
+    the (high, low) pairs of TIERS.
+    """
+    boundaries = [float(x) for x in tiers.split(',')]
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+def format_tiers(tiers):
+    return ','.join(str(x) for x in [tiers[0][0]] + [low for _, low in tiers])
+
+def main():
+    args = parse_arguments()
+
+    global VERBOSE
+    VERBOSE = args.verbose
+
+    non_targeting_controls = build_non_targeting_controls(args)
+    safe_targeting_controls = build_safe_targeting_controls(args)
+
+    if args.sweep:
+        sweep(args, non_targeting_controls, safe_targeting_controls)
+        return
+
+    parameters = parameter_grid(args)[0]
+    gene_targeting_guides = build_gene_targeting_guides(args, parameters)
+
+    full_library = assemble_library(
+        gene_targeting_guides,
+        non_targeting_controls,
+        safe_targeting_controls,
     )
 
     full_library.to_csv(args.outfile)
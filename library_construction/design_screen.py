@@ -1,9 +1,13 @@
 import pandas as pd
 import argparse
+import multiprocessing
+import os
 import random
 
 from funcy import ilen
 
+from selection import group_nlargest, group_nsmallest
+
 A549_COLUMNS = [
     'A549_Vehicle_Lung_1_A01',
     'A549_Vehicle_Lung_2_A05'
@@ -15,8 +19,8 @@ NUM_NON_ESSENTIAL = 135
 NUM_ESSENTIAL     = 100
 NUM_CONTROLS      = 100
 
-def build_control_guides(all_libraries):
-    seeds = [random.randint(0, 1000), random.randint(0, 1000)]
+def build_control_guides(all_libraries, rng=random):
+    seeds = [rng.randint(0, 1000), rng.randint(0, 1000)]
     
     non_targeting_controls = all_libraries[all_libraries['Type'] == 'non_targeting_control'].sample(NUM_CONTROLS, random_state=seeds[0])
     safe_targeting_controls = all_libraries[all_libraries['Type'] == 'safe_targeting_control'].sample(NUM_CONTROLS, random_state=seeds[1])
@@ -27,20 +31,18 @@ def build_non_essential_guides(all_libraries, non_essential_genes):
 
     bassik_ne_guides = non_essential_guides[non_essential_guides['Library'] == 'Bassik2017'].copy()
     bassik_ne_guides['Num Off-Targets'] = bassik_ne_guides[['0 Off-Targets', '1 Off-Targets', '2 Off-Targets', '3 Off-Targets']].sum(axis=1)
-    bassik_ne_genes = bassik_ne_guides.groupby('Gene')['Num Off-Targets'].apply(lambda df: df.nlargest(2))
-    bassik_ne_genes = set(bassik_ne_genes.groupby('Gene').mean().nlargest(NUM_NON_ESSENTIAL).index)
+    bassik_ne_genes = group_nlargest(bassik_ne_guides, 'Gene', 'Num Off-Targets', 2)
+    bassik_ne_genes = set(bassik_ne_genes.groupby('Gene')['Num Off-Targets'].mean().nlargest(NUM_NON_ESSENTIAL).index)
     bassik_ne_guides = bassik_ne_guides[bassik_ne_guides['Gene'].isin(bassik_ne_genes)]
 
-    non_essential_guides = non_essential_guides.groupby(['Library', 'Gene']) \
-                                               .Specificity \
-                                               .apply(lambda df: df.nsmallest(2)) \
-                                               .groupby(['Library', 'Gene']) \
-                                               .mean() \
-                                               .groupby('Library') \
-                                               .nsmallest(NUM_NON_ESSENTIAL).index.tolist()
+    non_essential_guides = group_nsmallest(non_essential_guides, ['Library', 'Gene'], 'Specificity', 2) \
+                               .groupby(['Library', 'Gene']) \
+                               .Specificity \
+                               .mean() \
+                               .reset_index()
 
-    non_essential_guides = [(x, z) for (x, _, z) in non_essential_guides]
-    non_essential_guides = pd.DataFrame(non_essential_guides, columns=['Library', 'Gene'])
+    non_essential_guides = group_nsmallest(non_essential_guides, 'Library', 'Specificity', NUM_NON_ESSENTIAL)
+    non_essential_guides = non_essential_guides[['Library', 'Gene']].reset_index(drop=True)
     non_essential_guides = non_essential_guides[non_essential_guides['Library'] != 'Guidescan']
     non_essential_guides = non_essential_guides[non_essential_guides['Library'] != 'Bassik2017']
     non_essential_guides = non_essential_guides.merge(all_libraries, how='inner')
@@ -101,16 +103,20 @@ def get_non_essential_genes(args, expressed_genes, common_genes):
     non_essential_genes = (set(non_essential_df['Nonessential Genes (NE)']) - expressed_genes) & common_genes
     return set(non_essential_genes)
 
-def get_essential_genes(args, expressed_genes):
+def load_essential_genes(args, expressed_genes):
     essential_genes = set(map(
         lambda x: x.split()[0],
         open(args.essential_genes_txt).readlines()
     ))
 
     essential_genes = essential_genes & expressed_genes
-    essential_genes = sorted(essential_genes) # to ensure deterministic operation
-    essential_genes = random.sample(essential_genes, NUM_ESSENTIAL)
-    return set(essential_genes)
+    return sorted(essential_genes) # to ensure deterministic operation
+
+def sample_essential_genes(essential_genes, rng=random):
+    return set(rng.sample(essential_genes, NUM_ESSENTIAL))
+
+def get_essential_genes(args, expressed_genes, rng=random):
+    return sample_essential_genes(load_essential_genes(args, expressed_genes), rng)
 
 def get_expressed_genes(common_genes, args):
     gene_expression_df = pd.read_csv(args.gene_expression_csv)
@@ -162,31 +168,30 @@ def parse_arguments():
         help='Name of output CSV.'
     )
 
-    return parser.parse_args()
-
-def main():
-    args = parse_arguments()
-
-    random.seed(74) # easter egg: email me the closest prime number to this seed
-
-    all_libraries       = load_all_df(args)
-    common_genes        = set.intersection(*all_libraries.groupby('Library').Gene.agg(lambda x: set(x)))
+    parser.add_argument(
+        '--replicates', type=int,
+        help=('Draw this many screen designs, each from its own random seed, '
+              'writing them and a summary table to --outdir.')
+    )
 
-    expressed_genes     = get_expressed_genes(common_genes, args)
-    essential_genes     = get_essential_genes(args, expressed_genes)
-    non_essential_genes = get_non_essential_genes(args, expressed_genes, common_genes)
+    parser.add_argument(
+        '--seed', type=int, default=74,
+        help='Random seed; replicate i uses SEED + i.'
+    )
 
-    essential_guides = build_essential_guides(
-        all_libraries, essential_genes
+    parser.add_argument(
+        '--outdir', default='replicates',
+        help='Output directory for --replicates.'
     )
 
-    non_essential_guides = build_non_essential_guides(
-        all_libraries, non_essential_genes
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='Number of processes drawing replicate designs.'
     )
 
-    controls = build_control_guides(all_libraries)
+    return parser.parse_args()
 
-    screen_df = pd.concat([essential_guides, non_essential_guides, controls])
+def finish_screen(screen_df):
     unnamed_columns = list(filter(lambda s: s.startswith('Unnamed'), screen_df.columns))
     screen_df.drop(columns=unnamed_columns, inplace=True)
     screen_df['G/C Content'] = screen_df['sgRNA'].apply(
@@ -200,6 +205,106 @@ def main():
         '3 Off-Targets': 'Distance 3 Matches',
     })
 
+    return screen_df
+
+def design_screen(all_libraries, essential_genes, non_essential_guides, rng=random):
+    essential_guides = build_essential_guides(
+        all_libraries, essential_genes
+    )
+
+    controls = build_control_guides(all_libraries, rng)
+
+    screen_df = pd.concat([essential_guides, non_essential_guides, controls])
+    return finish_screen(screen_df)
+
+#####################
+## Replicate mode ##
+#####################
+
+REPLICATE_STATE = {}
+
+def init_replicate_worker(all_libraries, essential_genes, non_essential_guides, seed, outdir):
+    REPLICATE_STATE.update(
+        all_libraries=all_libraries,
+        essential_genes=essential_genes,
+        non_essential_guides=non_essential_guides,
+        seed=seed,
+        outdir=outdir,
+    )
+
+def design_replicate(replicate):
+    """
+    Draws the design of one replicate from its own seed, as a single run
+    with --seed SEED + replicate would, and writes it to its partition.
+    """
+    seed = REPLICATE_STATE['seed'] + replicate
+    rng = random.Random(seed)
+
+    essential_genes = sample_essential_genes(REPLICATE_STATE['essential_genes'], rng)
+    screen_df = design_screen(
+        REPLICATE_STATE['all_libraries'], essential_genes, REPLICATE_STATE['non_essential_guides'], rng
+    )
+
+    partition = os.path.join(REPLICATE_STATE['outdir'], f'replicate={replicate}')
+    os.makedirs(partition, exist_ok=True)
+    screen_df.to_csv(os.path.join(partition, 'screen.csv'))
+
+    return summarize_screen(screen_df, replicate, seed)
+
+def summarize_screen(screen_df, replicate, seed):
+    summary = {
+        'Replicate': replicate,
+        'Seed': seed,
+        'Guides': len(screen_df),
+        'Genes': screen_df['Gene'].nunique(),
+    }
+
+    for screen_type, guides in screen_df.groupby('Type'):
+        summary[f'{screen_type} Guides'] = len(guides)
+        summary[f'{screen_type} Genes'] = guides['Gene'].nunique()
+        summary[f'{screen_type} Mean Specificity'] = guides['Specificity'].mean()
+
+    summary['Mean G/C Content'] = screen_df['G/C Content'].mean()
+    return summary
+
+def draw_replicates(args, all_libraries, essential_genes, non_essential_guides):
+    init_args = (all_libraries, essential_genes, non_essential_guides, args.seed, args.outdir)
+
+    os.makedirs(args.outdir, exist_ok=True)
+    if args.workers > 1:
+        with multiprocessing.Pool(args.workers, init_replicate_worker, init_args) as pool:
+            summaries = pool.map(design_replicate, range(args.replicates), chunksize=1)
+    else:
+        init_replicate_worker(*init_args)
+        summaries = list(map(design_replicate, range(args.replicates)))
+
+    pd.DataFrame(summaries).to_csv(os.path.join(args.outdir, 'summary.csv'), index=False)
+
+def main():
+    args = parse_arguments()
+
+    random.seed(args.seed) # easter egg: email me the closest prime number to this seed
+
+    all_libraries       = load_all_df(args)
+    common_genes        = set.intersection(*all_libraries.groupby('Library').Gene.agg(lambda x: set(x)))
+
+    expressed_genes     = get_expressed_genes(common_genes, args)
+    essential_genes     = load_essential_genes(args, expressed_genes)
+    non_essential_genes = get_non_essential_genes(args, expressed_genes, common_genes)
+
+    # the non-essential guides are deterministic, so replicates share them
+    non_essential_guides = build_non_essential_guides(
+        all_libraries, non_essential_genes
+    )
+
+    if args.replicates:
+        draw_replicates(args, all_libraries, essential_genes, non_essential_guides)
+        return
+
+    screen_df = design_screen(
+        all_libraries, sample_essential_genes(essential_genes), non_essential_guides
+    )
+
     screen_df.to_csv(args.outfile)
 
 if __name__ == '__main__':
@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+
+def group_top_k(df, by, column, k, ascending=False):
+    """
+    Selects the k rows with the largest (smallest if ascending) column
+    values in every by group, with one sort instead of a Python call per
+    group. Returns the same rows in the same order as
+
+        df.groupby(by).apply(lambda g: g.nlargest(k, column))
+
+    that is, groups in sorted key order and rows in rank order, with ties
+    kept in their original order. As with nlargest, rows with a missing key
+    are dropped and rows with a missing value only fill groups with fewer
+    than k others, in their original order.
+    """
+    by = [by] if isinstance(by, str) else list(by)
+    df = df.dropna(subset=by)
+    if len(df) == 0:
+        return df
+
+    codes = [pd.factorize(df[col], sort=True)[0] for col in by]
+    values = df[column].to_numpy(dtype=np.float64)
+    missing = np.isnan(values)
+    values = np.where(missing, 0, values if ascending else -values)
+
+    # stable lexicographic sort on (group, missing value last, value, position)
+    order = np.lexsort([np.arange(len(df)), values, missing] + codes[::-1])
+
+    new_group = np.zeros(len(df) - 1, dtype=bool)
+    for col_codes in codes:
+        col_codes = col_codes[order]
+        new_group |= col_codes[1:] != col_codes[:-1]
+    starts = np.flatnonzero(np.r_[True, new_group])
+    sizes = np.diff(np.r_[starts, len(df)])
+    position = np.arange(len(df)) - np.repeat(starts, sizes)
+
+    return df.iloc[order[position < k]]
+
+def group_nlargest(df, by, column, k):
+    return group_top_k(df, by, column, k, ascending=False)
+
+def group_nsmallest(df, by, column, k):
+    return group_top_k(df, by, column, k, ascending=True)